@@ -0,0 +1,69 @@
+""" Per-feature cost of writing one matched object to the tabular outputs.
+
+    Features are written the same way Handler does: one shared Geometry and
+    one list of values per theme, converted to the column types by
+    Theme.values, handed to every output.
+
+    PYTHONPATH=. python benchmarks/bench_outputs.py [-n FEATURES] [-m MAPPING]
+"""
+import argparse
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+
+import osm_export_tool.tabular as tabular
+from osm_export_tool import GeomType
+from osm_export_tool.mapping import Mapping
+
+MAPPINGS_DIR = os.path.join(os.path.dirname(__file__),'..','osm_export_tool','mappings')
+
+# a random tag value for a column of field's type.
+def tag_value(rand,field):
+    if field.type == 'integer':
+        return str(rand.randint(0,100))
+    if field.type == 'real':
+        return str(round(rand.uniform(0,1000),1))
+    return 'value{0}'.format(rand.randint(0,100))
+
+def features(mapping,count,seed=0):
+    rand = random.Random(seed)
+    themes = [t for t in mapping.themes if t.points]
+    for i in range(count):
+        theme = themes[i % len(themes)]
+        tags = {field.name:tag_value(rand,field) for field in theme.fields if rand.random() < 0.5}
+        wkb = struct.pack('<BIdd',1,1,rand.uniform(-180,180),rand.uniform(-90,90))
+        yield i + 1, theme, tabular.Geometry(wkb), tags
+
+def run(output_classes,mapping,count,tempdir):
+    outputs = [cls(os.path.join(tempdir,cls.__name__.lower()),mapping) for cls in output_classes]
+    start = time.perf_counter()
+    for osm_id, theme, geom, tags in features(mapping,count):
+        values = theme.values(tags)
+        for output in outputs:
+            output.write(osm_id,theme.name,GeomType.POINT,geom,values)
+    for output in outputs:
+        output.finalize()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark writing features to tabular outputs.')
+    parser.add_argument('-n', dest='count', type=int, default=100000, help='Number of features (default: 100000)')
+    parser.add_argument('-m', '--mapping', dest='mapping', default=os.path.join(MAPPINGS_DIR,'HDX_v2.yml'), help='YAML mapping (default: HDX_v2.yml)')
+    parsed = parser.parse_args()
+
+    with open(parsed.mapping,'r') as f:
+        mapping = Mapping(f.read())
+
+    for output_classes in [[tabular.Geopackage],[tabular.Shapefile],[tabular.Kml],[tabular.Geopackage,tabular.Shapefile,tabular.Kml]]:
+        tempdir = tempfile.mkdtemp()
+        try:
+            elapsed = run(output_classes,mapping,parsed.count,tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+        print('{0:<30} {1:8.2f} us/feature'.format('+'.join(c.__name__ for c in output_classes),elapsed / parsed.count * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+""" Deterministic synthetic OSM files for benchmarking.
+
+    The same arguments always produce the same file. Tags are drawn from
+    weighted distributions loosely modelled on a typical country extract:
+    most nodes are untagged or carry only metadata tags, most ways are
+    highways or buildings, and multipolygons are buildings, landuse and water.
+
+    PYTHONPATH=. python benchmarks/fixtures.py OUTPUT.osm.pbf [--nodes N] [--ways N] [--multipolygons N]
+"""
+import argparse
+import math
+import os
+import random
+
+import osmium as o
+
+# (weight, tags); values that are lists are picked from at random.
+NODE_TAGS = [
+    (60, {}),
+    (15, {'created_by':['JOSM','iD','Potlatch']}),
+    (8, {'source':['survey','bing','gps']}),
+    (5, {'addr:housenumber':['1','2','15','23a'],'addr:street':['Main Street','High Street']}),
+    (4, {'amenity':['school','hospital','clinic','place_of_worship','bank','pharmacy'],'name':['Name A','Name B']}),
+    (3, {'shop':['supermarket','convenience','bakery'],'name':['Shop A','Shop B']}),
+    (2, {'place':['village','town','hamlet'],'name':['Place A','Place B'],'population':['120','5000']}),
+    (2, {'tourism':['hotel','guest_house'],'name':['Hotel A']}),
+    (1, {'natural':['tree','peak'],'ele':['12','350']}),
+]
+
+LINE_TAGS = [
+    (55, {'highway':['residential','service','track','path','unclassified','primary','secondary'],'name':['Road A','Road B'],'surface':['paved','unpaved'],'oneway':['yes','no']}),
+    (10, {'waterway':['stream','river','ditch'],'name':['River A']}),
+    (5, {'railway':['rail'],'gauge':['1435']}),
+    (5, {'power':['line'],'voltage':['11000']}),
+    (25, {'source':['bing']}),
+]
+
+CLOSED_WAY_TAGS = [
+    (70, {'building':['yes','house','residential'],'building:levels':['1','2','3'],'addr:housenumber':['4','7']}),
+    (15, {'landuse':['residential','farmland','forest']}),
+    (5, {'amenity':['school','hospital','parking'],'name':['Site A']}),
+    (5, {'leisure':['park','pitch']}),
+    (5, {'natural':['water','wood']}),
+]
+
+MULTIPOLYGON_TAGS = [
+    (40, {'building':['yes','commercial']}),
+    (30, {'landuse':['forest','meadow','farmland']}),
+    (20, {'natural':['water','wetland']}),
+    (10, {'leisure':['park']}),
+]
+
+def pick_tags(rand,distribution):
+    total = sum(weight for weight, tags in distribution)
+    r = rand.uniform(0,total)
+    for weight, tags in distribution:
+        r -= weight
+        if r <= 0:
+            break
+    return {k:(rand.choice(v) if isinstance(v,list) else v) for k, v in tags.items()}
+
+def synthesize(path,nodes=100000,ways=10000,multipolygons=1000,seed=0,bbox=(-1.0,-1.0,1.0,1.0)):
+    """ Writes nodes standalone nodes, ways ways (open and closed) and
+        multipolygons relations, with their member ways and nodes, to path. """
+    rand = random.Random(seed)
+    west, south, east, north = bbox
+    node_list = []
+    way_list = []
+    relation_list = []
+
+    def add_node(lon,lat,tags={}):
+        node_list.append((len(node_list) + 1,lon,lat,tags))
+        return len(node_list)
+
+    def add_ring(lon,lat,size,sides):
+        ids = [add_node(lon + size * math.cos(2 * math.pi * i / sides),lat + size * math.sin(2 * math.pi * i / sides)) for i in range(sides)]
+        return ids + [ids[0]]
+
+    def add_way(refs,tags):
+        way_list.append((len(way_list) + 1,refs,tags))
+        return len(way_list)
+
+    def random_point():
+        return rand.uniform(west,east), rand.uniform(south,north)
+
+    for i in range(nodes):
+        lon, lat = random_point()
+        add_node(lon,lat,pick_tags(rand,NODE_TAGS))
+
+    for i in range(ways):
+        lon, lat = random_point()
+        if rand.random() < 0.45:
+            add_way(add_ring(lon,lat,rand.uniform(0.0001,0.001),rand.randint(4,8)),pick_tags(rand,CLOSED_WAY_TAGS))
+        else:
+            refs = []
+            for j in range(rand.randint(2,12)):
+                refs.append(add_node(lon,lat))
+                lon += rand.uniform(-0.001,0.001)
+                lat += rand.uniform(-0.001,0.001)
+            add_way(refs,pick_tags(rand,LINE_TAGS))
+
+    for i in range(multipolygons):
+        lon, lat = random_point()
+        size = rand.uniform(0.001,0.01)
+        members = [('w',add_way(add_ring(lon,lat,size,rand.randint(6,24)),{}),'outer')]
+        if rand.random() < 0.3:
+            members.append(('w',add_way(add_ring(lon,lat,size / 3,rand.randint(4,8)),{}),'inner'))
+        tags = pick_tags(rand,MULTIPOLYGON_TAGS)
+        tags['type'] = 'multipolygon'
+        relation_list.append((len(relation_list) + 1,members,tags))
+
+    if os.path.exists(path):
+        os.remove(path)
+    writer = o.SimpleWriter(path)
+    try:
+        for node_id, lon, lat, tags in node_list:
+            writer.add_node(o.osm.mutable.Node(id=node_id,location=(lon,lat),tags=tags,version=1))
+        for way_id, refs, tags in way_list:
+            writer.add_way(o.osm.mutable.Way(id=way_id,nodes=refs,tags=tags,version=1))
+        for relation_id, members, tags in relation_list:
+            writer.add_relation(o.osm.mutable.Relation(id=relation_id,members=members,tags=tags,version=1))
+    finally:
+        writer.close()
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic OSM file.')
+    parser.add_argument('output', help='Output .osm.pbf')
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--ways', type=int, default=10000)
+    parser.add_argument('--multipolygons', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parsed = parser.parse_args()
+    synthesize(parsed.output,parsed.nodes,parsed.ways,parsed.multipolygons,parsed.seed)
+
+if __name__ == '__main__':
+    main()
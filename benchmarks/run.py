@@ -0,0 +1,181 @@
+""" Benchmarks tabular.Handler for every bundled mapping and tabular output class.
+
+    A deterministic fixture is synthesized (see fixtures.py), then each
+    (mapping, output) case runs in a fresh process so peak RSS is per case.
+    Results are printed and can be saved as JSON, and compared against a
+    previous JSON result to catch regressions.
+
+    PYTHONPATH=. python benchmarks/run.py [--nodes N] [--ways N] [--multipolygons N]
+        [--mappings HDX.yml,...] [--outputs gpkg,...] [--sqlite-profiles default,bulk] [--stats]
+        [-o result.json] [--compare baseline.json]
+
+    GeoPackage outputs run once per SQLite profile (see tabular.SQLITE_PROFILES);
+    cases with a profile other than default are labelled e.g. gpkg:bulk.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0,os.path.dirname(__file__))
+from fixtures import synthesize
+
+MAPPINGS_DIR = os.path.join(os.path.dirname(__file__),'..','osm_export_tool','mappings')
+MAPPINGS = ['default.yml','HDX.yml','HDX_v2.yml','InAWARE.yml']
+OUTPUTS = ['gpkg','multi_gpkg','multi_gpkg_threaded','shp','kml']
+SQLITE_OUTPUTS = ['gpkg','multi_gpkg','multi_gpkg_threaded']
+
+# counts features written, alongside the real output.
+class Counter:
+    def __init__(self):
+        self.features = 0
+        self.files = []
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        self.features += 1
+
+    def finalize(self):
+        pass
+
+def run_case(osm_file,mapping_name,output_name,tempdir,collect_stats=False,sqlite_profile='default'):
+    import osm_export_tool.tabular as tabular
+    from osm_export_tool.mapping import Mapping
+
+    output_classes = {
+        'gpkg':lambda name, mapping: tabular.Geopackage(name,mapping,profile=sqlite_profile),
+        'multi_gpkg':lambda name, mapping: tabular.MultiGeopackage(name,mapping,profile=sqlite_profile),
+        'multi_gpkg_threaded':lambda name, mapping: tabular.MultiGeopackage(name,mapping,threaded=True,profile=sqlite_profile),
+        'shp':tabular.Shapefile,
+        'kml':tabular.Kml
+    }
+    stages = {}
+    start = time.perf_counter()
+    with open(os.path.join(MAPPINGS_DIR,mapping_name),'r') as f:
+        mapping = Mapping(f.read())
+    output = output_classes[output_name](os.path.join(tempdir,'bench'),mapping)
+    counter = Counter()
+    stages['setup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = tabular.Stats() if collect_stats else None
+    h = tabular.Handler([output,counter],mapping,stats=stats)
+    h.apply_file(osm_file, locations=True, idx='flex_mem')
+    stages['handle'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output.finalize()
+    stages['finalize'] = time.perf_counter() - start
+
+    # breakdown of handle, from the handler's own timers
+    if stats:
+        for stage, seconds in stats.timers.items():
+            stages['handle:' + stage] = seconds
+
+    seconds = stages['handle'] + stages['finalize']
+    return {
+        'mapping':mapping_name,
+        'output':output_name if sqlite_profile == 'default' else output_name + ':' + sqlite_profile,
+        'sqlite_profile':sqlite_profile if output_name in SQLITE_OUTPUTS else None,
+        'bytes':sum(f.size() for f in output.files),
+        'features':counter.features,
+        'seconds':seconds,
+        'features_per_second':counter.features / seconds if seconds > 0 else 0,
+        'peak_rss_kb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages':stages
+    }
+
+def run_isolated(args):
+    osm_file, mapping_name, output_name, collect_stats, sqlite_profile = args
+    tempdir = tempfile.mkdtemp()
+    try:
+        return run_case(osm_file,mapping_name,output_name,tempdir,collect_stats,sqlite_profile)
+    finally:
+        shutil.rmtree(tempdir)
+
+def environment():
+    env = {'python':platform.python_version(),'platform':platform.platform()}
+    try:
+        from osgeo import gdal
+        env['gdal'] = gdal.__version__
+    except ImportError:
+        pass
+    return env
+
+def compare(results,baseline,threshold):
+    previous = {(r['mapping'],r['output']):r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        p = previous.get((r['mapping'],r['output']))
+        if not p or not p['features_per_second']:
+            continue
+        ratio = r['features_per_second'] / p['features_per_second']
+        flag = ''
+        if ratio < threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('{0:<14} {1:<24} {2:6.2f}x{3}'.format(r['mapping'],r['output'],ratio,flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tabular export hot path.')
+    parser.add_argument('--nodes', type=int, default=200000)
+    parser.add_argument('--ways', type=int, default=40000)
+    parser.add_argument('--multipolygons', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mappings', default=','.join(MAPPINGS), help='Comma-separated bundled mappings (default: all)')
+    parser.add_argument('--outputs', default=','.join(OUTPUTS), help='Comma-separated outputs (default: gpkg,multi_gpkg,multi_gpkg_threaded,shp,kml)')
+    parser.add_argument('--sqlite-profiles', default='default', help='Comma-separated SQLite profiles for GeoPackage outputs, e.g. default,bulk (default: default)')
+    parser.add_argument('--stats', action='store_true', help='Break down handle time with Handler stats (adds overhead)')
+    parser.add_argument('-o', dest='output', help='Write JSON results to this file')
+    parser.add_argument('--compare', dest='compare', help='JSON results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.9, help='Flag cases slower than this ratio of the baseline (default: 0.9)')
+    parsed = parser.parse_args()
+
+    fixture_dir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(fixture_dir,'fixture.osm.pbf')
+        start = time.perf_counter()
+        synthesize(osm_file,parsed.nodes,parsed.ways,parsed.multipolygons,parsed.seed)
+        fixture = {
+            'nodes':parsed.nodes,
+            'ways':parsed.ways,
+            'multipolygons':parsed.multipolygons,
+            'seed':parsed.seed,
+            'size_bytes':os.path.getsize(osm_file),
+            'seconds':time.perf_counter() - start
+        }
+
+        cases = []
+        for m in parsed.mappings.split(','):
+            for out in parsed.outputs.split(','):
+                profiles = parsed.sqlite_profiles.split(',') if out in SQLITE_OUTPUTS else ['default']
+                cases += [(osm_file,m,out,parsed.stats,profile) for profile in profiles]
+        results = []
+        ctx = multiprocessing.get_context('spawn')
+        for case in cases:
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run_isolated,(case,))
+            results.append(r)
+            print('{mapping:<14} {output:<24} {features:>9} features {features_per_second:>10.0f}/s {bytes:>11} bytes {peak_rss_kb:>9} KB peak'.format(**r))
+    finally:
+        shutil.rmtree(fixture_dir)
+
+    doc = {'fixture':fixture,'environment':environment(),'results':results}
+    if parsed.output:
+        with open(parsed.output,'w') as f:
+            json.dump(doc,f,indent=2)
+
+    if parsed.compare:
+        with open(parsed.compare,'r') as f:
+            baseline = json.load(f)
+        if compare(results,baseline,parsed.threshold) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
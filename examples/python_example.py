@@ -4,7 +4,7 @@ import osm_export_tool.nontabular as nontabular
 from osm_export_tool.mapping import Mapping
 from osm_export_tool.geometry import load_geometry
 from osm_export_tool.sources import Overpass, Pbf, OsmExpress, OsmiumTool
-from osm_export_tool.package import create_package, create_posm_bundle
+from osm_export_tool.package import Package, create_posm_bundle
 from os.path import join
 
 GEOJSON = """{
@@ -36,10 +36,15 @@ tabular_outputs = [shp,gpkg,kml]
 
 h = tabular.Handler(tabular_outputs,mapping)
 
-h.apply_file(source.path(), locations=True, idx='sparse_file_array')
+h.apply_file(source.path(), locations=True)
 
-for output in tabular_outputs:
-	output.finalize()
+shp.finalize()
+# the shapefiles are zipped in the background while the rest of the export runs
+shp_package = Package(join(tempdir,'shp.zip'),boundary_geom=geom)
+shp_package.add(shp.files)
+
+gpkg.finalize()
+kml.finalize()
 
 osmand_files = nontabular.osmand(source.path(),'tools/OsmAndMapCreator-main',tempdir=tempdir)
 garmin_files = nontabular.garmin(source.path(),'tools/splitter-r583/splitter.jar','tools/mkgmap-r3890/mkgmap.jar',tempdir=tempdir)
@@ -54,5 +59,5 @@ files += osmand_files
 files += garmin_files
 #files += mbtiles_files
 files.append(osm_export_tool.File('osm_pbf',[source.path()],''))
-create_package(join(tempdir,'shp.zip'),shp.files,boundary_geom=geom)
+shp_package.close()
 create_posm_bundle(join(tempdir,'bundle.tgz'),files,"Title","name","description",geom)
\ No newline at end of file
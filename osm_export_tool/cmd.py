@@ -1,6 +1,10 @@
 import os
 import sys
+import copy
+import json
 import time
+import shutil
+import tempfile
 import argparse
 import osm_export_tool.tabular as tabular
 import osm_export_tool.nontabular as nontabular
@@ -16,6 +20,15 @@ def main():
 	parser.add_argument('--clip', dest='clip',help='GeoJSON or POLY file to clip geometries.')
 	parser.add_argument('-v','--verbose', action='store_true')
 	parser.add_argument('--omit-osm-ids', action='store_true')
+	parser.add_argument('--workers', dest='workers',type=int,default=1,help='Number of processes for tabular formats (default: 1)')
+	parser.add_argument('--stats', action='store_true',help='Print per-stage timers and counters as JSON.')
+	parser.add_argument('--spatial-index', action='store_true',help='Build a spatial index for each GeoPackage layer when done.')
+	parser.add_argument('--sqlite-profile', dest='sqlite_profile',default='default',choices=sorted(tabular.SQLITE_PROFILES),help='SQLite settings for writing GeoPackages (default: default)')
+	parser.add_argument('--sqlite-page-size', dest='sqlite_page_size',type=int,help='SQLite page size of GeoPackages in bytes')
+	parser.add_argument('--sqlite-commit-every', dest='sqlite_commit_every',type=int,help='Commit GeoPackages every n features')
+	parser.add_argument('--sqlite-optimize', action='store_true',help='Run ANALYZE and VACUUM on GeoPackages when done.')
+	parser.add_argument('--index', dest='index',help='Node location index type, e.g. flex_mem, sparse_file_array, dense_mmap_array (default: chosen from input size)')
+	parser.add_argument('--index-dir', dest='index_dir',help='Directory for file-backed node location indexes (default: anonymous mmap or temporary files)')
 	parsed = parser.parse_args()
 
 	mapping_txt = None
@@ -35,10 +48,19 @@ def main():
 			clipping_geom = load_geometry(f.read())
 
 	formats = parsed.formats.split(',')
+
+	sqlite_profile = copy.copy(tabular.SQLITE_PROFILES[parsed.sqlite_profile])
+	if parsed.sqlite_page_size:
+		sqlite_profile.page_size = parsed.sqlite_page_size
+	if parsed.sqlite_commit_every:
+		sqlite_profile.commit_every = parsed.sqlite_commit_every
+	if parsed.sqlite_optimize:
+		sqlite_profile.analyze = True
+		sqlite_profile.vacuum = True
 	
 	tabular_outputs = []
 	if 'gpkg' in formats:
-		tabular_outputs.append(tabular.Geopackage(parsed.output_name,mapping))
+		tabular_outputs.append(tabular.Geopackage(parsed.output_name,mapping,spatial_index=parsed.spatial_index,profile=sqlite_profile))
 	if 'shp' in formats:
 		tabular_outputs.append(tabular.Shapefile(parsed.output_name,mapping))
 	if 'kml' in formats:
@@ -53,13 +75,32 @@ def main():
 		nontabular_outputs.append(nontabular.Osmand())
 
 	if len(tabular_outputs) > 0:
-		h = tabular.Handler(tabular_outputs,mapping,clipping_geom=clipping_geom)
+		if len(tabular_outputs) > 1:
+			# encode each format on its own thread
+			tabular_outputs = [tabular.ThreadedOutput(output) for output in tabular_outputs]
+		stats = tabular.Stats() if parsed.stats else None
 		start_time = time.time()
-		h.apply_file(parsed.osm_file, locations=True, idx='sparse_file_array')
+		if parsed.workers > 1:
+			tempdir = tempfile.mkdtemp(dir=parsed.index_dir or os.path.dirname(os.path.abspath(parsed.output_name)))
+			try:
+				tabular.apply_file_parallel(parsed.osm_file,tabular_outputs,mapping,parsed.workers,tempdir,clipping_geom=clipping_geom,stats=stats)
+			finally:
+				shutil.rmtree(tempdir)
+		else:
+			h = tabular.Handler(tabular_outputs,mapping,clipping_geom=clipping_geom,stats=stats)
+			h.apply_file(parsed.osm_file, locations=True, idx=parsed.index, index_dir=parsed.index_dir)
 
-		for output in tabular_outputs:
-			output.finalize()
-		print('Completed in {0} seconds.'.format(time.time() - start_time))
+		if stats:
+			stats.finalize(tabular_outputs)
+		else:
+			for output in tabular_outputs:
+				output.finalize()
+		elapsed = time.time() - start_time
+		print('Completed in {0} seconds.'.format(elapsed))
+		if stats:
+			d = stats.to_dict()
+			d['elapsed'] = elapsed
+			print(json.dumps(d,indent=2))
 
 		for output in tabular_outputs:
 			for file in output.files:
@@ -1,5 +1,7 @@
 import json
-from shapely.geometry import shape, MultiPolygon, Polygon
+from shapely.geometry import shape, box, MultiPolygon, Point, Polygon
+from shapely.ops import unary_union
+from shapely.prepared import prep
 
 
 def parse_poly(lines):
@@ -52,3 +54,155 @@ def load_geometry(txt):
     except json.decoder.JSONDecodeError:
         pass
     return parse_poly(txt.split("\n"))
+
+
+def vertex_count(geom):
+    if hasattr(geom, "geoms"):
+        return sum(vertex_count(g) for g in geom.geoms)
+    if geom.geom_type == "Polygon":
+        return len(geom.exterior.coords) + sum(len(r.coords) for r in geom.interiors)
+    return len(geom.coords)
+
+
+class ClippingGrid:
+    """A clipping geometry split into a grid of cells.
+    Features whose bounds cover a few cells are only tested and intersected
+    against the pieces of the geometry in those cells, and features covering
+    only cells entirely inside the geometry are kept without any test.
+    Larger features are clipped against the whole prepared geometry.
+    """
+
+    OUTSIDE = 0
+    INSIDE = 1
+    BOUNDARY = 2
+
+    # beyond this, building the union of the pieces costs more than it saves.
+    MAX_LOCAL_CELLS = 4
+
+    def __init__(self, geom, cell_vertices=64, max_cells=128):
+        self.geom = geom
+        self.prepared = prep(geom)
+        self.minx, self.miny, self.maxx, self.maxy = geom.bounds
+        # about cell_vertices vertices of the boundary per cell,
+        # rounded to a power of two so cells can be built as a quadtree.
+        n = 1
+        while n < max_cells and n * n * cell_vertices < vertex_count(geom):
+            n = n * 2
+        self.n = n
+        self.dx = (self.maxx - self.minx) / self.n or 1.0
+        self.dy = (self.maxy - self.miny) / self.n or 1.0
+
+        self.status = {}
+        self.pieces = {}
+        self._subdivide(0, 0, self.n, geom)
+        self._local = {}
+
+    def _box(self, i, j, size):
+        return box(
+            self.minx + i * self.dx,
+            self.miny + j * self.dy,
+            self.minx + (i + size) * self.dx,
+            self.miny + (j + size) * self.dy,
+        )
+
+    # each piece is cut from the piece of its parent quad, not the whole geometry.
+    def _subdivide(self, i0, j0, size, piece):
+        cell = self._box(i0, j0, size)
+        if self.prepared.contains_properly(cell):
+            for i in range(i0, i0 + size):
+                for j in range(j0, j0 + size):
+                    self.status[(i, j)] = ClippingGrid.INSIDE
+            return
+        if not self.prepared.intersects(cell):
+            return
+        piece = piece.intersection(cell)
+        if size == 1:
+            self.status[(i0, j0)] = ClippingGrid.BOUNDARY
+            self.pieces[(i0, j0)] = piece
+            return
+        half = size // 2
+        for i, j in [
+            (i0, j0),
+            (i0 + half, j0),
+            (i0, j0 + half),
+            (i0 + half, j0 + half),
+        ]:
+            self._subdivide(i, j, half, piece)
+
+    def _index(self, v, origin, size):
+        return min(self.n - 1, max(0, int((v - origin) // size)))
+
+    # returns the range of cells covered by bounds, or None if they are
+    # outside the grid, and whether bounds extend beyond the grid.
+    def _cells(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        if maxx < self.minx or maxy < self.miny or minx > self.maxx or miny > self.maxy:
+            return None, True
+        key = (
+            self._index(minx, self.minx, self.dx),
+            self._index(maxx, self.minx, self.dx),
+            self._index(miny, self.miny, self.dy),
+            self._index(maxy, self.miny, self.dy),
+        )
+        beyond = (
+            minx < self.minx or miny < self.miny or maxx > self.maxx or maxy > self.maxy
+        )
+        return key, beyond
+
+    # the clipping geometry restricted to the cells in pieces, prepared.
+    # these are cached, at most as many as there are boundary cells, so the
+    # cache holds a few copies of the geometry at most.
+    def _local_geom(self, pieces):
+        key = tuple(pieces)
+        if key not in self._local:
+            if len(self._local) > len(self.pieces):
+                self._local = {}
+            geoms = [
+                self.pieces[(i, j)] if (i, j) in self.pieces else self._box(i, j, 1)
+                for i, j in pieces
+            ]
+            local = geoms[0] if len(geoms) == 1 else unary_union(geoms)
+            self._local[key] = (local, prep(local))
+        return self._local[key]
+
+    def contains_point(self, x, y):
+        if x < self.minx or y < self.miny or x > self.maxx or y > self.maxy:
+            return False
+        status = self.status.get(
+            (self._index(x, self.minx, self.dx), self._index(y, self.miny, self.dy)),
+            ClippingGrid.OUTSIDE,
+        )
+        if status == ClippingGrid.INSIDE:
+            return True
+        if status == ClippingGrid.OUTSIDE:
+            return False
+        return self.prepared.contains(Point(x, y))
+
+    def clip(self, geom):
+        """Returns None if geom is outside the clipping geometry,
+        geom itself if it is inside, or else the intersection."""
+        key, beyond = self._cells(geom.bounds)
+        if key is None:
+            return None
+        i0, i1, j0, j1 = key
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > ClippingGrid.MAX_LOCAL_CELLS:
+            local, prepared_local = self.geom, self.prepared
+        else:
+            statuses = set()
+            pieces = []
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    status = self.status.get((i, j), ClippingGrid.OUTSIDE)
+                    statuses.add(status)
+                    if status != ClippingGrid.OUTSIDE:
+                        pieces.append((i, j))
+            if not beyond and statuses == {ClippingGrid.INSIDE}:
+                return geom
+            if not pieces:
+                return None
+            local, prepared_local = self._local_geom(pieces)
+        if not prepared_local.intersects(geom):
+            return None
+        if prepared_local.contains_properly(geom):
+            return geom
+        return local.intersection(geom)
@@ -1,11 +1,75 @@
+import math
 import yaml
 import pyparsing
 from osm_export_tool import GeomType
-from osm_export_tool.sql import Matcher
+from osm_export_tool.sql import Matcher, triggers, is_exact
 
 class InvalidMapping(Exception):
 	pass
 
+# the range of 64-bit integer columns.
+INTEGER_MIN = -(1 << 63)
+INTEGER_MAX = (1 << 63) - 1
+
+# parsed exactly, not through float; a '.0' suffix is the only fraction allowed.
+def to_integer(s):
+	s = s.strip()
+	if s.endswith('.0'):
+		s = s[:-2]
+	try:
+		i = int(s)
+	except ValueError:
+		return None
+	if i < INTEGER_MIN or i > INTEGER_MAX:
+		return None
+	return i
+
+def to_real(s):
+	try:
+		f = float(s)
+	except ValueError:
+		return None
+	return f if math.isfinite(f) else None
+
+FIELD_TYPES = {'string':None,'integer':to_integer,'real':to_real}
+
+# types of well-known numeric keys, used when select: doesn't give one.
+INFERRED_TYPES = {
+	'admin_level':'integer',
+	'building:levels':'real',
+	'capacity':'integer',
+	'capacity:persons':'integer',
+	'lanes':'integer',
+	'population':'integer',
+	'ele':'real'
+}
+
+class Field:
+	""" The type and width of a column. Values that don't parse as the type are null.
+		The type is inferred if select: doesn't give one; see Theme.unparsed. """
+
+	def __init__(self,name,type=None,width=None):
+		self.name = name
+		self.inferred = type is None and name in INFERRED_TYPES
+		self.type = type or INFERRED_TYPES.get(name,'string')
+		if self.type not in FIELD_TYPES:
+			raise InvalidMapping('type: for column {0} must be one of: {1}'.format(name,', '.join(FIELD_TYPES)))
+		if width is not None and (not isinstance(width,int) or isinstance(width,bool) or width < 1):
+			raise InvalidMapping('width: for column {0} must be a positive integer'.format(name))
+		self.width = width
+		self.convert = FIELD_TYPES[self.type]
+
+	@classmethod
+	def from_select(cls,theme_name,item):
+		if isinstance(item,str):
+			return cls(item)
+		if isinstance(item,dict) and len(item) == 1:
+			name, spec = next(iter(item.items()))
+			spec = spec or {}
+			if isinstance(name,str) and isinstance(spec,dict) and set(spec) <= {'type','width'}:
+				return cls(name,spec.get('type'),spec.get('width'))
+		raise InvalidMapping('select: for theme {0} must be a list of keys, or of keys with type: and width: e.g. - population: {{type: integer}}'.format(theme_name))
+
 class Theme:
 	def __init__(self,name,d,default_osm_id):
 		self.name = name
@@ -38,13 +102,26 @@ class Theme:
 
 		if 'select' not in d:
 			raise InvalidMapping('missing select: for theme {0}'.format(name))
-		self.keys = set(d['select'])
+		fields = [Field.from_select(name,item) for item in d['select']]
+		self.keys = set(f.name for f in fields)
 
 		self.osm_id = default_osm_id
 		if 'osm_id' in self.keys:
 			self.osm_id = True
 			self.keys.remove('osm_id')
 
+		# keys in select: order, the column order of every output.
+		by_name = {}
+		for f in fields:
+			if f.name != 'osm_id':
+				by_name.setdefault(f.name,f)
+		self.fields = list(by_name.values())
+		self.columns = [f.name for f in self.fields]
+		# (index, convert) of the columns that aren't strings
+		self.conversions = [(i, f.convert) for i, f in enumerate(self.fields) if f.convert]
+		# indexes of the columns with an inferred type
+		self.inferred = [i for i, f in enumerate(self.fields) if f.inferred]
+
 		if 'where' in d:
 			try:
 				if not d['where']:
@@ -81,9 +158,67 @@ class Theme:
 
 		return self.matcher.matches(tags)
 
+	# values of the columns in tags, converted to the column types.
+	def values(self,tags):
+		values = [tags.get(column) for column in self.columns]
+		for i, convert in self.conversions:
+			if values[i] is not None:
+				values[i] = convert(values[i])
+		return values
+
+	# columns with an inferred type whose value in tags didn't parse, and is null in values.
+	def unparsed(self,tags,values):
+		return [self.columns[i] for i in self.inferred if values[i] is None and self.columns[i] in tags]
+
 	def __repr__(self):
 		return self.name
 
+class ThemeIndex:
+	""" Dispatches tags to the themes of one geometry type that can match them,
+		keyed by tag key and by tag key=value, so that only themes with a relevant
+		tag present are evaluated. """
+
+	def __init__(self,themes):
+		self.themes = themes
+		self.always = set() # themes that can match without any particular key
+		self.exact = set() # themes where a key hit is already a match
+		self.by_key = {}
+		self.by_value = {}
+		for i, theme in enumerate(themes):
+			t = triggers(theme.matcher.expr)
+			if t is None:
+				self.always.add(i)
+				continue
+			if is_exact(theme.matcher.expr):
+				self.exact.add(i)
+			for key, value in t:
+				if value is None:
+					self.by_key.setdefault(key,set()).add(i)
+				else:
+					self.by_value.setdefault(key,{}).setdefault(value,set()).add(i)
+
+		# at least one of these keys must be present for any theme to match;
+		# None if some theme can match without any particular key.
+		self.keys = None if self.always else frozenset(self.by_key) | frozenset(self.by_value)
+
+	def matching(self,tags):
+		hits = set(self.always)
+		by_key = self.by_key
+		by_value = self.by_value
+		for key in tags:
+			if key in by_key:
+				hits.update(by_key[key])
+			if key in by_value:
+				values = by_value[key]
+				value = tags[key]
+				if value in values:
+					hits.update(values[value])
+		if not hits:
+			return []
+		themes = self.themes
+		exact = self.exact
+		return [themes[i] for i in sorted(hits) if i in exact or themes[i].matcher.matches(tags)]
+
 
 class Mapping:
 	def __init__(self,y,default_osm_id=True):
@@ -96,6 +231,21 @@ class Mapping:
 		for theme_name, theme_dict in doc.items():
 			self.themes.append(Theme(theme_name,theme_dict,default_osm_id=default_osm_id))
 
+		self.indexes = {
+			GeomType.POINT:ThemeIndex([t for t in self.themes if t.points]),
+			GeomType.LINE:ThemeIndex([t for t in self.themes if t.lines]),
+			GeomType.POLYGON:ThemeIndex([t for t in self.themes if t.polygons])
+		}
+
+	# tags must be a dict. returns the matching themes in mapping order.
+	def matching_themes(self,geom_type,tags):
+		return self.indexes[geom_type].matching(tags)
+
+	# the set of tag keys that can possibly produce a match for geom_type,
+	# or None if some theme can match without any particular key.
+	def relevant_keys(self,geom_type):
+		return self.indexes[geom_type].keys
+
 	@classmethod
 	def validate(cls,y,**kwargs):
 		try:
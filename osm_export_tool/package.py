@@ -1,67 +1,385 @@
+import collections
+import hashlib
 import json
 import os
 from os.path import basename
 import zipfile
+import zlib
 import tarfile
 import io
+import queue
+import threading
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import mapping
 from osm_export_tool import File
 
-def create_package(destination,files,boundary_geom=None,output_name='zip'):
-    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED, True) as z:
+# parts that are already compressed, and are stored as is.
+STORED_SUFFIXES = ('.pbf','.mbtiles','.zip','.gz','.tgz','.obf','.img','.mwm')
+
+CHUNK_SIZE = 1 << 20
+
+# raw deflate of one chunk of a member. chunks are compressed independently,
+# primed with the end of the previous chunk, and all but the last end on a
+# byte boundary without the final block bit, so they concatenate into one
+# deflate stream, like pigz.
+def deflate_chunk(chunk,zdict,level,last):
+    if zdict:
+        c = zlib.compressobj(level,zlib.DEFLATED,-15,zdict=zdict)
+    else:
+        c = zlib.compressobj(level,zlib.DEFLATED,-15)
+    return c.compress(chunk) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+# yields (chunk, last) for each chunk, and at least one, possibly empty, chunk.
+def mark_last(chunks):
+    it = iter(chunks)
+    chunk = next(it,b'')
+    for next_chunk in it:
+        yield chunk, False
+        chunk = next_chunk
+    yield chunk, True
+
+def read_chunks(path,chunk_size):
+    with open(path,'rb') as f:
+        yield from mark_last(iter(lambda: f.read(chunk_size),b''))
+
+# joins or splits an iterable of bytes into chunk_size chunks.
+def rechunk(chunks,chunk_size):
+    buffer = bytearray()
+    for data in chunks:
+        buffer += data
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    yield bytes(buffer)
+
+def write_members(z,members,compresslevel=6,workers=None,stored_suffixes=STORED_SUFFIXES,chunk_size=CHUNK_SIZE):
+    """ Writes members to the open ZipFile z. Each member is (arcname, source),
+        where source is a path, or an iterable of bytes that is consumed as it is produced.
+
+        Chunks of the members are deflated on a pool of threads, a bounded number
+        ahead of the one being written, and written in order; the members' local
+        headers are rewritten with their sizes and CRC once complete.
+        Paths with a suffix in stored_suffixes, or all members if compresslevel is 0, are stored.
+        Returns the number of bytes read. """
+    workers = workers or os.cpu_count() or 1
+    bytes_in = 0
+    with ThreadPoolExecutor(workers) as executor:
+        def chunks():
+            for arcname, source in members:
+                if isinstance(source,str):
+                    zinfo = zipfile.ZipInfo.from_file(source,arcname)
+                    stored = compresslevel == 0 or source.lower().endswith(stored_suffixes)
+                    # the rewritten header must be the same size, so zip64 is decided up front
+                    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+                    source_chunks = read_chunks(source,chunk_size)
+                else:
+                    zinfo = zipfile.ZipInfo(arcname,time.localtime()[:6])
+                    zinfo.external_attr = 0o644 << 16
+                    stored = compresslevel == 0
+                    zip64 = True # size unknown
+                    source_chunks = mark_last(rechunk(source,chunk_size))
+                zinfo.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+                previous = None
+                for chunk, last in source_chunks:
+                    if stored:
+                        yield zinfo, zip64, chunk, last, None
+                    else:
+                        zdict = previous[-32768:] if previous else None
+                        yield zinfo, zip64, chunk, last, executor.submit(deflate_chunk,chunk,zdict,compresslevel,last)
+                    previous = chunk
+
+        started = None # the member being written
+        pending = collections.deque()
+        def write(zinfo,zip64,chunk,last,future):
+            nonlocal started, bytes_in
+            if started is not zinfo:
+                # sizes are placeholders until the member is complete
+                zinfo.header_offset = z.fp.tell()
+                zinfo.CRC = 0
+                zinfo.compress_size = 0
+                zinfo.file_size = 0
+                z.fp.write(zinfo.FileHeader(zip64))
+                started = zinfo
+            data = future.result() if future else chunk
+            z.fp.write(data)
+            zinfo.CRC = zlib.crc32(chunk,zinfo.CRC)
+            zinfo.compress_size += len(data)
+            zinfo.file_size += len(chunk)
+            bytes_in += len(chunk)
+            if last:
+                end = z.fp.tell()
+                z.fp.seek(zinfo.header_offset)
+                z.fp.write(zinfo.FileHeader(zip64))
+                z.fp.seek(end)
+                # register the member like ZipFile.write, for the central directory
+                z.filelist.append(zinfo)
+                z.NameToInfo[zinfo.filename] = zinfo
+                z.start_dir = end
+                started = None
+
+        for item in chunks():
+            pending.append(item)
+            if len(pending) > workers * 2:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+    return bytes_in
+
+class StreamWriter:
+    """ Writable file-like object whose bytes are packaged as they are written,
+        see Package.open. Writes block while the package is behind. """
+
+    def __init__(self,maxsize=16):
+        self.queue = queue.Queue(maxsize)
+
+    def write(self,data):
+        self.queue.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        self.queue.put(None)
+
+    def chunks(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            yield data
+
+class Package:
+    """ A zip package that is written while the export is still running.
+
+        add() queues the parts of Files, e.g. of an output as soon as its finalize()
+        returns, and open() a member streamed from a StreamWriter. Members are
+        compressed with write_members on a background thread, in the order they
+        were queued; a stream must be closed before later members are written, so
+        one thread shouldn't interleave writes to several streams.
+        close() waits for all members, and returns the File of the package.
+        If stats is a dict, close() fills it with the bytes read and written,
+        seconds taken and throughput in MB/s of input. """
+
+    def __init__(self,destination,boundary_geom=None,output_name='zip',compresslevel=6,workers=None,stored_suffixes=STORED_SUFFIXES,stats=None):
+        self.destination = destination
+        self.output_name = output_name
+        self.compresslevel = compresslevel
+        self.workers = workers
+        self.stored_suffixes = stored_suffixes
+        self.stats = stats
+        self.start = time.perf_counter()
+        self.bytes_in = 0
+        self.error = None
+        self.z = zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED, True)
         if boundary_geom:
-            z.writestr("clipping_boundary.geojson", json.dumps(mapping(boundary_geom)))
-        for file in files:
-            for part in file.parts:
-                z.write(part, os.path.basename(part))
+            self.z.writestr("clipping_boundary.geojson", json.dumps(mapping(boundary_geom)))
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
 
-    return File(output_name,[destination])
+    def run(self):
+        while True:
+            members = self.queue.get()
+            if members is None:
+                return
+            try:
+                if not self.error:
+                    self.bytes_in += write_members(self.z,members,self.compresslevel,self.workers,self.stored_suffixes)
+            except Exception as e:
+                self.error = e
+            finally:
+                # unblock the writers of streams that won't be packaged
+                for arcname, source in members:
+                    if not isinstance(source,str):
+                        for data in source:
+                            pass
 
-def create_posm_bundle(destination,files,title,name,description,geom):
+    def add(self,files):
+        self.queue.put([(os.path.basename(part),part) for file in files for part in file.parts])
+
+    def open(self,arcname):
+        stream = StreamWriter()
+        self.queue.put([(arcname,stream.chunks())])
+        return stream
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.z.close()
+        if self.error:
+            raise self.error
+        if self.stats is not None:
+            seconds = time.perf_counter() - self.start
+            self.stats['bytes_in'] = self.bytes_in
+            self.stats['bytes_out'] = os.path.getsize(self.destination)
+            self.stats['seconds'] = seconds
+            self.stats['mb_per_second'] = self.bytes_in / seconds / 1000000 if seconds > 0 else 0
+        return File(self.output_name,[self.destination])
+
+def create_package(destination,files,boundary_geom=None,output_name='zip',compresslevel=6,workers=None,stored_suffixes=STORED_SUFFIXES,stats=None):
+    """ Zips the parts of files, deflating them in parallel; see Package. """
+    package = Package(destination,boundary_geom,output_name,compresslevel,workers,stored_suffixes,stats)
+    package.add(files)
+    return package.close()
+
+class ParallelGzipWriter:
+    """ Writable file-like object that gzips what is written to it into fileobj,
+        as one gzip member whose chunks are deflated on a pool of threads like
+        write_members. close() writes the trailer, but doesn't close fileobj. """
+
+    def __init__(self,fileobj,compresslevel=6,workers=None,chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.previous = None
+        self.crc = 0
+        self.size = 0
+        # magic, deflate, no flags, mtime, no extra flags, unknown OS
+        fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I',int(time.time())) + b'\x00\xff')
+
+    def write(self,data):
+        self.buffer += data
+        # the last chunk is left for close(), which finishes the deflate stream
+        while len(self.buffer) > self.chunk_size:
+            self.submit(bytes(self.buffer[:self.chunk_size]),False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def submit(self,chunk,last):
+        zdict = self.previous[-32768:] if self.previous else None
+        self.pending.append(self.executor.submit(deflate_chunk,chunk,zdict,self.compresslevel,last))
+        self.crc = zlib.crc32(chunk,self.crc)
+        self.size += len(chunk)
+        self.previous = chunk
+        while len(self.pending) > self.workers * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        self.submit(bytes(self.buffer),True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.write(struct.pack('<II',self.crc,self.size & 0xffffffff))
+        self.shutdown()
+
+    # stops the compression threads; chunks not yet written are dropped.
+    def shutdown(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+
+class HashingReader:
+    """ Wraps a file object opened for reading, hashing what is read through it. """
+
+    def __init__(self,fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self,size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+def file_sha256(path,chunk_size=CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path,'rb') as f:
+        for data in iter(lambda: f.read(chunk_size),b''):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+# adds part to the tar bundle as target, or as a hard link to an identical part
+# added before: the same file, or a file of the same size and checksum. the same
+# file added again as the same target is skipped.
+# added maps (st_dev, st_ino) to the (target, size, sha256) of the parts added.
+# returns the size and sha256 of part; for new content these are computed while
+# it is added, only parts with the size of an earlier one are read twice.
+def add_part(bundle,part,target,added):
+    st = os.stat(part)
+    inode = (st.st_dev,st.st_ino)
+    link = added.get(inode)
+    if link is None:
+        same_size = [a for a in added.values() if a[1] == st.st_size]
+        if same_size:
+            checksum = file_sha256(part)
+            link = next((a for a in same_size if a[2] == checksum),None)
+    if link and link[0] == target:
+        pass # already in the bundle
+    elif link:
+        tarinfo = bundle.gettarinfo(part,target)
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = link[0]
+        tarinfo.size = 0
+        bundle.addfile(tarinfo)
+    else:
+        tarinfo = bundle.gettarinfo(part,target)
+        with open(part,'rb') as f:
+            reader = HashingReader(f)
+            bundle.addfile(tarinfo,reader)
+        link = (target,st.st_size,reader.sha256.hexdigest())
+    added.setdefault(inode,link)
+    return {'size':link[1],'sha256':link[2]}
+
+def create_posm_bundle(destination,files,title,name,description,geom,compresslevel=6,workers=None):
+    """ Writes a POSM bundle, a .tgz of the parts of files and a manifest.json
+        listing them with their sizes and sha256 checksums.
+        The tar stream is gzipped in parallel with ParallelGzipWriter, and parts
+        identical to one already in the bundle are added as hard links to it. """
     contents = {}
-    with tarfile.open(destination, "w|gz") as bundle:
-        for file in files:
-            for part in file.parts:
-                if file.output_name == 'shp':
-                    target = 'data/' + basename(part)
-                    contents[target] = {'Type':'ESRI Shapefile'}
-                elif file.output_name == 'kml':
-                    target = 'data/' + basename(part)
-                    contents[target] = {'Type':'KML'}
-                elif file.output_name == 'gpkg':
-                    target = 'data/' + basename(part)
-                    contents[target] = {'Type':'Geopackage'}
-                elif file.output_name == 'osmand_obf':
-                    target = 'navigation/' + basename(part)
-                    contents[target] = {'Type':'OsmAnd'}
-                elif file.output_name == 'garmin':
-                    target = 'navigation/' + basename(part)
-                    contents[target] = {'Type':'Garmin IMG'}
-                elif file.output_name == 'mwm':
-                    target = 'navigation/' + basename(part)
-                    contents[target] = {'Type':'Maps.me'}
-                elif file.output_name == 'osm_pbf':
-                    target = 'osm/' + basename(part)
-                    contents[target] = {'Type':'OSM/PBF'}
-                elif file.output_name == 'mbtiles':
-                    target = 'tiles/' + basename(part)
-                    contents[target] = {
-                        'type':'MBTiles',
-                        'minzoom':file.extra['minzoom'],
-                        'maxzoom':file.extra['maxzoom'],
-                        'source':file.extra['source']
-                    }
-                bundle.add(part,target)
-
-        data = json.dumps({
-            'title':title,
-            'name':name,
-            'description':description,
-            'bbox':geom.bounds,
-            'contents':contents
-        },indent=2).encode()
-        tarinfo = tarfile.TarInfo('manifest.json')
-        tarinfo.size = len(data)
-        bundle.addfile(tarinfo, io.BytesIO(data))
+    added = {}
+    with open(destination,'wb') as f:
+        gz = ParallelGzipWriter(f,compresslevel,workers)
+        try:
+            with tarfile.open(fileobj=gz,mode='w|') as bundle:
+                for file in files:
+                    for part in file.parts:
+                        if file.output_name == 'shp':
+                            target = 'data/' + basename(part)
+                            contents[target] = {'Type':'ESRI Shapefile'}
+                        elif file.output_name == 'kml':
+                            target = 'data/' + basename(part)
+                            contents[target] = {'Type':'KML'}
+                        elif file.output_name == 'gpkg':
+                            target = 'data/' + basename(part)
+                            contents[target] = {'Type':'Geopackage'}
+                        elif file.output_name == 'osmand_obf':
+                            target = 'navigation/' + basename(part)
+                            contents[target] = {'Type':'OsmAnd'}
+                        elif file.output_name == 'garmin':
+                            target = 'navigation/' + basename(part)
+                            contents[target] = {'Type':'Garmin IMG'}
+                        elif file.output_name == 'mwm':
+                            target = 'navigation/' + basename(part)
+                            contents[target] = {'Type':'Maps.me'}
+                        elif file.output_name == 'osm_pbf':
+                            target = 'osm/' + basename(part)
+                            contents[target] = {'Type':'OSM/PBF'}
+                        elif file.output_name == 'mbtiles':
+                            target = 'tiles/' + basename(part)
+                            contents[target] = {
+                                'type':'MBTiles',
+                                'minzoom':file.extra['minzoom'],
+                                'maxzoom':file.extra['maxzoom'],
+                                'source':file.extra['source']
+                            }
+                        contents[target].update(add_part(bundle,part,target,added))
+
+                data = json.dumps({
+                    'title':title,
+                    'name':name,
+                    'description':description,
+                    'bbox':geom.bounds,
+                    'contents':contents
+                },indent=2).encode()
+                tarinfo = tarfile.TarInfo('manifest.json')
+                tarinfo.size = len(data)
+                bundle.addfile(tarinfo, io.BytesIO(data))
+            gz.close()
+        finally:
+            gz.shutdown()
 
     return File('bundle',[destination])
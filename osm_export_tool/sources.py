@@ -1,9 +1,11 @@
+import hashlib
 import json
 import os
 import pathlib
 import ast
 import shutil
 import subprocess
+import tempfile
 import time
 from sre_constants import SUCCESS
 from string import Template
@@ -11,6 +13,7 @@ from xml.dom import ValidationErr
 
 import requests
 import shapely.geometry
+import shapely.ops
 from deepdiff import DeepDiff
 from requests.exceptions import Timeout
 
@@ -21,6 +24,140 @@ MAX_RETRIES = 5
 RETRY_DELAY = 60
 
 
+def file_version(path):
+    """The identity and modification time of a file, for cache keys."""
+    st = os.stat(path)
+    return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+
+class ExtractCache:
+    """Content-addressed cache of extracts in a directory, shared by sources.
+
+    Entries are keyed by a hash of everything the extract depends on, e.g. the
+    version of the source file, the clip geometry and the tag filters, so a
+    hit is always safe to reuse. Hits are copied to the output path, and the
+    least recently used entries are evicted once the cache exceeds max_bytes.
+
+    Entries put with a boundary are also registered as regional extracts of
+    their source, see parent().
+    """
+
+    SUFFIX = ".osm.pbf"
+
+    def __init__(self, directory, max_bytes=20 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def boundary_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key, output_path):
+        """Copies the entry for key to output_path. Returns False on a miss."""
+        entry = self.entry(key)
+        try:
+            os.utime(entry)
+            shutil.copyfile(entry, output_path)
+        except FileNotFoundError:
+            # missing, or evicted by another process meanwhile
+            return False
+        return True
+
+    def put(self, key, path, boundary=None, source=None):
+        """Adds a copy of path as the entry for key, then evicts old entries.
+        If boundary is given, the entry is registered as the extract of source
+        within boundary."""
+        if os.path.getsize(path) > self.max_bytes:
+            return
+        self.replace(self.entry(key), lambda tmp_path: shutil.copyfile(path, tmp_path))
+        if boundary is not None:
+            info = {"source": source, "boundary": shapely.geometry.mapping(boundary)}
+
+            def write(tmp_path):
+                with open(tmp_path, "w") as f:
+                    json.dump(info, f)
+
+            self.replace(self.boundary_path(key), write)
+        self.evict(keep=key)
+
+    # writes a file with write(tmp_path), and moves it to path once complete.
+    def replace(self, path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def parent(self, source, geom):
+        """The smallest registered extract of source whose boundary contains geom,
+        or None."""
+        best = None
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[: -len(".json")]
+            try:
+                with open(self.boundary_path(key)) as f:
+                    info = json.load(f)
+                size = os.path.getsize(self.entry(key))
+            except (FileNotFoundError, ValueError):
+                continue
+            if info.get("source") != source:
+                continue
+            if not shapely.geometry.shape(info["boundary"]).contains(geom):
+                continue
+            if best is None or size < best[0]:
+                best = (size, self.entry(key))
+        if best is None:
+            return None
+        try:
+            os.utime(best[1])
+        except FileNotFoundError:
+            return None
+        return best[1]
+
+    def entries(self):
+        """(mtime, size, path) of the entries, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        keep = keep and self.entry(keep)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for p in (path, path[: -len(self.SUFFIX)] + ".json"):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+
 class Pbf:
     def __init__(self, path):
         self._path = path
@@ -34,7 +171,14 @@ class Pbf:
 
 class OsmExpress:
     def __init__(
-        self, osmx_path, db_path, geom, output_path, use_existing=True, tempdir=None
+        self,
+        osmx_path,
+        db_path,
+        geom,
+        output_path,
+        use_existing=True,
+        tempdir=None,
+        cache=None,
     ):
         self.osmx_path = osmx_path
         self.db_path = db_path
@@ -42,6 +186,10 @@ class OsmExpress:
         self.output_path = output_path
         self.use_existing = use_existing
         self.tempdir = tempdir
+        self.cache = cache
+
+    def cache_key(self):
+        return ExtractCache.key("osmx", file_version(self.db_path), self.geom.wkb_hex)
 
     def fetch(self):
         region_json = os.path.join(self.tempdir, "region.json")
@@ -62,8 +210,12 @@ class OsmExpress:
     def path(self):
         if os.path.isfile(self.output_path) and self.use_existing:
             return self.output_path
-        else:
-            self.fetch()
+        key = self.cache and self.cache_key()
+        if key and self.cache.get(key, self.output_path):
+            return self.output_path
+        self.fetch()
+        if key:
+            self.cache.put(key, self.output_path)
         return self.output_path
 
 
@@ -77,6 +229,7 @@ class OsmiumTool:
         use_existing=True,
         tempdir=None,
         mapping=None,
+        cache=None,
     ):
         self.osmium_path = osmium_path
         self.source_path = source_path
@@ -85,6 +238,15 @@ class OsmiumTool:
         self.use_existing = use_existing
         self.tempdir = tempdir
         self.mapping = mapping
+        self.cache = cache
+
+    def cache_key(self, filtered=True):
+        filters = None
+        if filtered and self.mapping is not None:
+            filters = sorted(OsmiumTool.filters(self.mapping))
+        return ExtractCache.key(
+            "osmium", file_version(self.source_path), self.geom.wkb_hex, filters
+        )
 
     @classmethod
     def parts(cls, expr):
@@ -154,32 +316,138 @@ class OsmiumTool:
                     {"type": "Feature", "geometry": shapely.geometry.mapping(self.geom)}
                 )
             )
-        subprocess.check_call(
-            [
-                self.osmium_path,
-                "extract",
-                "-p",
-                region_json,
-                self.source_path,
-                "-o",
-                self.output_path,
-                "--overwrite",
-            ]
-        )
+
+        def extract(source_path):
+            subprocess.check_call(
+                [
+                    self.osmium_path,
+                    "extract",
+                    "-p",
+                    region_json,
+                    source_path,
+                    "-o",
+                    self.output_path,
+                    "--overwrite",
+                ]
+            )
+
+        # a cached extract of the source that contains geom is much smaller
+        parent = None
+        if self.cache:
+            parent = self.cache.parent(file_version(self.source_path), self.geom)
+        try:
+            extract(parent or self.source_path)
+        except subprocess.CalledProcessError:
+            if parent is None:
+                raise
+            # e.g. the parent was evicted meanwhile
+            extract(self.source_path)
         os.remove(region_json)
 
+    # registers the unfiltered extract at output_path, to serve later AOIs within it
+    def cache_extract(self):
+        self.cache.put(
+            self.cache_key(filtered=False),
+            self.output_path,
+            boundary=self.geom,
+            source=file_version(self.source_path),
+        )
+
+    @classmethod
+    def extract_many(cls, osmium_path, source_path, extracts, tempdir, cache=None):
+        """Extracts many (geom, output_path) pairs from source_path in a single pass
+        with osmium extract --config, instead of reading the source once for each.
+        Returns a Pbf for each pair, in order.
+
+        With a cache, extracts already cached are copied from it, the rest are
+        read from a cached parent containing all of them if there is one, and
+        are registered in the cache once done."""
+        tools = [
+            cls(
+                osmium_path,
+                source_path,
+                geom,
+                output_path,
+                tempdir=tempdir,
+                cache=cache,
+            )
+            for geom, output_path in extracts
+        ]
+        if cache:
+            tools = [
+                t
+                for t in tools
+                if not cache.get(t.cache_key(filtered=False), t.output_path)
+            ]
+
+        if tools:
+            config = []
+            for t in tools:
+                geometry = shapely.geometry.mapping(t.geom)
+                if geometry["type"] not in ("Polygon", "MultiPolygon"):
+                    raise ValueError(
+                        "{0} can't be extracted, only polygons".format(t.output_path)
+                    )
+                config.append(
+                    {
+                        "output": os.path.abspath(t.output_path),
+                        geometry["type"].lower(): geometry["coordinates"],
+                    }
+                )
+            config_json = os.path.join(tempdir, "extracts.json")
+            with open(config_json, "w") as f:
+                json.dump({"extracts": config}, f)
+
+            def extract(source_path):
+                subprocess.check_call(
+                    [
+                        osmium_path,
+                        "extract",
+                        "-c",
+                        config_json,
+                        source_path,
+                        "--overwrite",
+                    ]
+                )
+
+            parent = None
+            if cache:
+                union = shapely.ops.unary_union([t.geom for t in tools])
+                parent = cache.parent(file_version(source_path), union)
+            try:
+                extract(parent or source_path)
+            except subprocess.CalledProcessError:
+                if parent is None:
+                    raise
+                extract(source_path)
+            finally:
+                os.remove(config_json)
+
+            if cache:
+                for t in tools:
+                    t.cache_extract()
+
+        return [Pbf(output_path) for geom, output_path in extracts]
+
     def path(self):
         if os.path.isfile(self.output_path) and self.use_existing:
             return self.output_path
+        key = self.cache and self.cache_key()
+        if key and self.cache.get(key, self.output_path):
+            return self.output_path
 
         planet_as_source = True
         if self.geom.area < 6e4:
             self.fetch()
             planet_as_source = False
+            if self.cache:
+                self.cache_extract()
 
         if self.mapping is not None:
             filters = OsmiumTool.filters(self.mapping)
             self.tags_filter(filters, planet_as_source)
+            if key:
+                self.cache.put(key, self.output_path)
 
         return self.output_path
 
@@ -237,6 +505,7 @@ class Overpass:
         osmconvert_path="osmconvert",
         mapping=None,
         use_curl=False,
+        cache=None,
     ):
         self.hostname = hostname
         self._path = path
@@ -247,8 +516,9 @@ class Overpass:
         self.mapping = mapping
         self.use_curl = use_curl
         self.tempdir = tempdir
+        self.cache = cache
 
-    def fetch(self):
+    def query(self):
         base_template = Template(
             "[maxsize:$maxsize][timeout:$timeout];$query;out meta;"
         )
@@ -286,7 +556,28 @@ class Overpass:
         else:
             query = "(node({0});<;>>;>;)".format(geom)
 
-        data = base_template.substitute(maxsize=2147483648, timeout=1600, query=query)
+        return base_template.substitute(maxsize=2147483648, timeout=1600, query=query)
+
+    def timestamp(self):
+        """The time of the latest data on the server, or None if unknown."""
+        try:
+            r = requests.get(
+                os.path.join(self.hostname, "api", "timestamp"), timeout=10
+            )
+            r.raise_for_status()
+        except requests.exceptions.RequestException:
+            return None
+        return r.text.strip() or None
+
+    # None if the server's data can't be dated, as a cached extract might be stale.
+    def cache_key(self):
+        timestamp = self.timestamp()
+        if timestamp is None:
+            return None
+        return ExtractCache.key("overpass", self.hostname, timestamp, self.query())
+
+    def fetch(self):
+        data = self.query()
 
         if self.use_curl:
             with open(os.path.join(self.tempdir, "query.txt"), "w") as query_txt:
@@ -330,8 +621,12 @@ class Overpass:
     def path(self):
         if os.path.isfile(self._path) and self.use_existing:
             return self._path
-        else:
-            self.fetch()
+        key = self.cache and self.cache_key()
+        if key and self.cache.get(key, self._path):
+            return self._path
+        self.fetch()
+        if key:
+            self.cache.put(key, self._path)
         return self._path
 
 
@@ -97,6 +97,43 @@ def _match(d,tags):
         return d[1] in tags and str(tags[d[1]]) <= str(d[2])
     raise Exception
 
+# returns the set of (key, value) pairs, at least one of which must be present
+# in tags for d to match; a value of None means any value of the key.
+# returns None if d can match without any particular key (e.g. !=).
+def triggers(d):
+    if len(d) == 0:
+        return set()
+    op = d[0]
+    if op == 'or':
+        left, right = triggers(d[1]), triggers(d[2])
+        if left is None or right is None:
+            return None
+        return left | right
+    elif op == 'and':
+        left, right = triggers(d[1]), triggers(d[2])
+        if left is None:
+            return right
+        if right is None:
+            return left
+        # prefer the side with fewer any-value keys, as it is more selective
+        return min(left, right, key=lambda s: (sum(1 for k, v in s if v is None), len(s)))
+    elif op == '=':
+        return {(d[1],d[2])}
+    elif op == 'in':
+        return {(d[1],v) for v in d[2]}
+    elif op == '!=':
+        return None
+    return {(d[1],None)}
+
+# true if any trigger of d being present in tags is sufficient for a match.
+def is_exact(d):
+    if len(d) == 0:
+        return True
+    op = d[0]
+    if op == 'or':
+        return is_exact(d[1]) and is_exact(d[2])
+    return op in ('=','in','notnull')
+
 def to_prefix(sql):
     def prefixform(d):
         if 'or' in d:
@@ -115,12 +152,53 @@ def to_prefix(sql):
             return ('in',strip_quotes(d['columnName']),d['rval'])
     return prefixform(whereExpression.parseString(sql,parseAll=True).asDict())
 
+# compiles d into a single python function equivalent to _match(d,tags).
+# keys and constants are bound as globals of the generated function,
+# IN lists become frozensets and comparison constants are pre-stringified.
+def compile_expr(d):
+    consts = {}
+    def const(value):
+        name = 'c{0}'.format(len(consts))
+        consts[name] = value
+        return name
+
+    # collect operands of chained and/or, so unions of many where: clauses
+    # don't produce deeply nested source.
+    def operands(op,e):
+        if len(e) > 0 and e[0] == op:
+            return operands(op,e[1]) + operands(op,e[2])
+        return [e]
+
+    def gen(e):
+        if len(e) == 0:
+            return 'False'
+        op = e[0]
+        if op == 'or' or op == 'and':
+            return '(' + (' ' + op + ' ').join(gen(x) for x in operands(op,e)) + ')'
+        key = const(e[1])
+        if op == '=':
+            return '(tags.get({0}) == {1})'.format(key,const(e[2]))
+        elif op == 'notnull':
+            return '({0} in tags)'.format(key)
+        elif op == 'in':
+            return '(tags.get({0}) in {1})'.format(key,const(frozenset(e[2])))
+        elif op == '!=':
+            return '(tags.get({0}) != {1})'.format(key,const(e[2]))
+        elif op in ('>','<','>=','<='):
+            return '({0} in tags and str(tags[{0}]) {1} {2})'.format(key,op,const(str(e[2])))
+        raise Exception
+
+    src = 'lambda tags: ' + gen(d)
+    return eval(compile(src,'<matcher>','eval'),consts)
+
 class Matcher:
     def __init__(self,expr):
         self.expr = expr
+        self.matches = compile_expr(expr)
 
-    def matches(self,tags):
-        return _match(self.expr,tags)
+    # the compiled function can't be pickled, so rebuild it from expr
+    def __reduce__(self):
+        return (Matcher,(self.expr,))
 
     # returns a new matcher
     def union(self,other_matcher):
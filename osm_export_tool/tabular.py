@@ -1,17 +1,24 @@
 from base64 import b64decode
+import multiprocessing
 import os
+import pickle
+import queue
 import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
 
 import osmium as o
 import osgeo.ogr as ogr
 import osgeo.osr as osr
 from shapely.wkb import loads, dumps
-from shapely.prepared import prep
 
 from osm_export_tool import GeomType, File
+from osm_export_tool.geometry import ClippingGrid
 
 fab = o.geom.WKBFactory()
-create_geom = lambda b : ogr.CreateGeometryFromWkb(bytes.fromhex(b))
 epsg_4326 = osr.SpatialReference()
 epsg_4326.ImportFromEPSG(4326)
 
@@ -26,60 +33,113 @@ def closed_way_is_polygon(tags):
             return True
     return False
 
+# copies an osmium TagList into a dict, so each tag is only read once.
+def tags_dict(tags):
+    return {t.k: t.v for t in tags}
+
+# true if any key of an osmium TagList is in keys; None means any key may match.
+def has_relevant_key(tags,keys):
+    return keys is None or not keys.isdisjoint(t.k for t in tags)
+
+# the column values of theme in tags.
+def theme_values(theme,tags):
+    return theme.values(tags)
+
+# little-endian WKB point, without going through the hex WKBFactory.
+def point_wkb(location):
+    return struct.pack('<BIdd',1,1,location.lon,location.lat)
+
+def linestring_wkb(w):
+    return bytes.fromhex(fab.create_linestring(w))
+
+def multipolygon_wkb(a):
+    return bytes.fromhex(fab.create_multipolygon(a))
+
+class Geometry:
+    """ Binary WKB of a feature, shared by all outputs.
+        The OGR geometry is only created once, when an output first needs it. """
+    __slots__ = ('wkb','_ogr')
+
+    def __init__(self,wkb,ogr_geom=None):
+        self.wkb = wkb
+        self._ogr = ogr_geom
+
+    @property
+    def ogr(self):
+        if self._ogr is None:
+            self._ogr = ogr.CreateGeometryFromWkb(self.wkb)
+        return self._ogr
+
 def make_filename(s):
     return s.lower().replace(' ','_')
 
+OGR_FIELD_TYPES = {'string':ogr.OFTString,'integer':ogr.OFTInteger64,'real':ogr.OFTReal}
+
+# the OGR field for a mapping Field; strings without a width get default_width.
+def field_defn(name,field,default_width=None):
+    defn = ogr.FieldDefn(name,OGR_FIELD_TYPES[field.type])
+    width = field.width or (default_width if field.type == 'string' else None)
+    if width:
+        defn.SetWidth(width)
+    return defn
+
+# (file name, OGR geometry type, theme) of the one-geometry-type layers of
+# Kml and Shapefile, keyed like their layers. Those create a layer on its
+# first feature, so themes and geometry types without features leave no files.
+def layer_specs(output_name,mapping):
+    specs = {}
+    for t in mapping.themes:
+        name = output_name + '_' + make_filename(t.name)
+        if t.points:
+            specs[(t.name,GeomType.POINT)] = (name + '_points',ogr.wkbPoint,t)
+        if t.lines:
+            specs[(t.name,GeomType.LINE)] = (name + '_lines',ogr.wkbLineString,t)
+        if t.polygons:
+            specs[(t.name,GeomType.POLYGON)] = (name + '_polygons',ogr.wkbMultiPolygon,t)
+    return specs
+
 class Kml:
     class Layer:
         def __init__(self,driver,file_name,ogr_geom_type,theme):
-            self.columns = theme.keys
+            self.columns = theme.columns
             self.ds = driver.CreateDataSource(file_name + '.kml')
             self.ogr_layer = self.ds.CreateLayer(theme.name, epsg_4326, ogr_geom_type)
 
             if theme.osm_id:
                 self.osm_id = True
-                field_name = ogr.FieldDefn('osm_id', ogr.OFTInteger64)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
+                self.ogr_layer.CreateField(ogr.FieldDefn('osm_id', ogr.OFTInteger64))
             else:
                 self.osm_id = False
+            # index of the first column field
+            self.offset = 1 if self.osm_id else 0
 
-            for column in self.columns:
-                field_name = ogr.FieldDefn(column, ogr.OFTString)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
+            for field in theme.fields:
+                self.ogr_layer.CreateField(field_defn(field.name,field))
 
             self.defn = self.ogr_layer.GetLayerDefn()
 
     def __init__(self,output_name,mapping):
-        driver = ogr.GetDriverByName('KML')
-
+        self.driver = ogr.GetDriverByName('KML')
         self.files = []
         self.layers = {}
-        for t in mapping.themes:
-            name = output_name + '_' + make_filename(t.name)
-            if t.points:
-                self.layers[(t.name,GeomType.POINT)] = Kml.Layer(driver,name + '_points',ogr.wkbPoint,t)
-                self.files.append(File('kml',[name + '_points.kml'],{'theme':t.name}))
-            if t.lines:
-                self.layers[(t.name,GeomType.LINE)] = Kml.Layer(driver,name + '_lines',ogr.wkbLineString,t)
-                self.files.append(File('kml',[name + '_lines.kml'],{'theme':t.name}))
-            if t.polygons:
-                self.layers[(t.name,GeomType.POLYGON)] = Kml.Layer(driver,name + '_polygons',ogr.wkbMultiPolygon,t)
-                self.files.append(File('kml',[name + '_polygons.kml'],{'theme':t.name}))
-
-    def write(self,osm_id,layer_name,geom_type,geom,tags):
-        layer = self.layers[(layer_name,geom_type)]
+        self.layer_specs = layer_specs(output_name,mapping)
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        layer = self.layers.get((layer_name,geom_type))
+        if layer is None:
+            file_name, ogr_geom_type, theme = self.layer_specs[(layer_name,geom_type)]
+            layer = self.layers[(layer_name,geom_type)] = Kml.Layer(self.driver,file_name,ogr_geom_type,theme)
         feature = ogr.Feature(layer.defn)
-        feature.SetGeometry(geom)
+        feature.SetGeometry(geom.ogr)
         if layer.osm_id:
-            feature.SetField('osm_id',osm_id)
-        for col in layer.columns:
-            if col in tags:
-                feature.SetField(col,tags[col])
+            feature.SetField(0,osm_id)
+        for i, value in enumerate(values,layer.offset):
+            if value is not None:
+                feature.SetField(i,value)
         layer.ogr_layer.CreateFeature(feature)
 
     def finalize(self):
+        self.files = [File('kml',[file_name + '.kml'],{'theme':theme.name}) for key, (file_name, ogr_geom_type, theme) in self.layer_specs.items() if key in self.layers]
         self.layers = None
         self.ds = None
 
@@ -89,60 +149,118 @@ class Shapefile:
             def launderName(col):
                 return re.sub(r'[^a-zA-Z0-9_]', '', col)[0:10]
 
-            self.columns = theme.keys
+            self.columns = theme.columns
             self.ds = driver.CreateDataSource(file_name + '.shp')
-            self.ogr_layer = self.ds.CreateLayer(theme.name, epsg_4326, ogr_geom_type,options=['ENCODING=UTF-8'])
+            # RESIZE: shrink each .dbf field to its longest value when closed
+            self.ogr_layer = self.ds.CreateLayer(theme.name, epsg_4326, ogr_geom_type,options=['ENCODING=UTF-8','RESIZE=YES'])
 
             if theme.osm_id:
                 self.osm_id = True
-                field_name = ogr.FieldDefn('osm_id', ogr.OFTInteger64)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
+                self.ogr_layer.CreateField(ogr.FieldDefn('osm_id', ogr.OFTInteger64))
             else:
                 self.osm_id = False
+            # index of the first column field
+            self.offset = 1 if self.osm_id else 0
 
-            self.launderedNames = {}
-            for column in self.columns:
-                laundered_name = launderName(column)
-                field_name = ogr.FieldDefn(laundered_name, ogr.OFTString)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
-                self.launderedNames[column] = laundered_name
+            for field in theme.fields:
+                self.ogr_layer.CreateField(field_defn(launderName(field.name),field,default_width=254))
 
             self.defn = self.ogr_layer.GetLayerDefn()
 
     def __init__(self,output_name,mapping):
-        driver = ogr.GetDriverByName('ESRI Shapefile')
-
+        self.driver = ogr.GetDriverByName('ESRI Shapefile')
         self.files = []
         self.layers = {}
-        for t in mapping.themes:
-            name = output_name + '_' + make_filename(t.name)
-            if t.points:
-                self.layers[(t.name,GeomType.POINT)] = Shapefile.Layer(driver,name + '_points',ogr.wkbPoint,t)
-                self.files.append(File.shp(name + '_points',{'theme':t.name}))
-            if t.lines:
-                self.layers[(t.name,GeomType.LINE)] = Shapefile.Layer(driver,name + '_lines',ogr.wkbLineString,t)
-                self.files.append(File.shp(name + '_lines',{'theme':t.name}))
-            if t.polygons:
-                self.layers[(t.name,GeomType.POLYGON)] = Shapefile.Layer(driver,name + '_polygons',ogr.wkbMultiPolygon,t)
-                self.files.append(File.shp(name + '_polygons',{'theme':t.name}))
-
-    def write(self,osm_id,layer_name,geom_type,geom,tags):
-        layer = self.layers[(layer_name,geom_type)]
+        self.layer_specs = layer_specs(output_name,mapping)
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        layer = self.layers.get((layer_name,geom_type))
+        if layer is None:
+            file_name, ogr_geom_type, theme = self.layer_specs[(layer_name,geom_type)]
+            layer = self.layers[(layer_name,geom_type)] = Shapefile.Layer(self.driver,file_name,ogr_geom_type,theme)
         feature = ogr.Feature(layer.defn)
-        feature.SetGeometry(geom)
+        feature.SetGeometry(geom.ogr)
         if layer.osm_id:
-            feature.SetField('osm_id',osm_id)
-        for col in layer.columns:
-            if col in tags:
-                feature.SetField(layer.launderedNames[col],tags[col])
+            feature.SetField(0,osm_id)
+        for i, value in enumerate(values,layer.offset):
+            if value is not None:
+                feature.SetField(i,value)
         layer.ogr_layer.CreateFeature(feature)
 
     def finalize(self):
+        self.files = [File.shp(file_name,{'theme':theme.name}) for key, (file_name, ogr_geom_type, theme) in self.layer_specs.items() if key in self.layers]
         self.layers = None
         self.ds = None
 
+# GeoPackage geometry blob header: magic, version 0, little-endian flags without envelope, srs_id 4326.
+GPKG_HEADER = b'GP' + bytes([0,1]) + struct.pack('<i',4326)
+
+def quote_identifier(s):
+    return '"' + s.replace('"','""') + '"'
+
+def quote_literal(s):
+    return "'" + s.replace("'","''") + "'"
+
+# runs sql on an OGR datasource, discarding any result set.
+def execute_sql(ds,sql):
+    result = ds.ExecuteSQL(sql)
+    if result is not None:
+        ds.ReleaseResultSet(result)
+
+# builds the R-tree of a GeoPackage table from its rows in one pass,
+# instead of updating it from triggers on every insert.
+def create_spatial_index(ds,table,geometry_column):
+    execute_sql(ds,'SELECT CreateSpatialIndex({0},{1})'.format(quote_literal(table),quote_literal(geometry_column)))
+
+class SqliteProfile:
+    """ SQLite settings for loading a GeoPackage.
+
+        journal_mode, synchronous and cache_size (pages, or KiB if negative)
+        are set on the loading connection only; None keeps the SQLite default.
+        page_size is set on the new, still empty file.
+        commit_every commits the load transaction every n features,
+        instead of once at the end, to bound the size of the journal.
+        analyze and vacuum are run once the file is complete. """
+
+    def __init__(self,journal_mode=None,synchronous=None,cache_size=None,page_size=None,commit_every=None,analyze=False,vacuum=False):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self.commit_every = commit_every
+        self.analyze = analyze
+        self.vacuum = vacuum
+
+    # statements to run before the load transaction begins.
+    def load_statements(self):
+        statements = []
+        if self.page_size:
+            statements += ['PRAGMA page_size={0}'.format(int(self.page_size)),'VACUUM']
+        if self.journal_mode:
+            statements.append('PRAGMA journal_mode={0}'.format(self.journal_mode))
+        if self.synchronous:
+            statements.append('PRAGMA synchronous={0}'.format(self.synchronous))
+        if self.cache_size:
+            statements.append('PRAGMA cache_size={0}'.format(int(self.cache_size)))
+        return statements
+
+    # statements to run on the complete file.
+    def finish_statements(self):
+        statements = []
+        if self.analyze:
+            statements.append('ANALYZE')
+        if self.vacuum:
+            statements.append('VACUUM')
+        return statements
+
+SQLITE_PROFILES = {
+    # SQLite defaults, one transaction for the whole export
+    'default':SqliteProfile(),
+    # no rollback journal or fsync while loading: a failed export leaves a corrupt file,
+    # which is discarded anyway. 256 MB of cache, committed every million features.
+    'bulk':SqliteProfile(journal_mode='OFF',synchronous='OFF',cache_size=-256 * 1024,commit_every=1000000)
+}
+
 class Geopackage:
     class Layer:
         def __init__(self,ds,theme):
@@ -150,80 +268,183 @@ class Geopackage:
 
             if theme.osm_id:
                 self.osm_id = True
-                field_name = ogr.FieldDefn('osm_id', ogr.OFTInteger64)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
+                self.ogr_layer.CreateField(ogr.FieldDefn('osm_id', ogr.OFTInteger64))
             else:
                 self.osm_id = False
 
-            self.columns = theme.keys
-            for column_name in self.columns:
-                field_name = ogr.FieldDefn(column_name, ogr.OFTString)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
-            self.defn = self.ogr_layer.GetLayerDefn()
+            self.columns = theme.columns
+            for field in theme.fields:
+                self.ogr_layer.CreateField(field_defn(field.name,field))
+            defn = self.ogr_layer.GetLayerDefn()
 
-    def __init__(self,output_name,mapping):
+            # rows are inserted with a prepared statement instead of through OGR.
+            self.table = self.ogr_layer.GetName()
+            self.geometry_column = self.ogr_layer.GetGeometryColumn()
+            names = [self.geometry_column] + [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+            self.sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                quote_identifier(self.table),
+                ','.join(quote_identifier(n) for n in names),
+                ','.join('?' for n in names)
+            )
+            self.rows = []
+            self.ogr_layer = None
+
+        def row(self,osm_id,geom,values):
+            if self.osm_id:
+                return [GPKG_HEADER + geom.wkb,osm_id] + values
+            return [GPKG_HEADER + geom.wkb] + values
+
+    # spatial_index: build an R-tree for each layer in finalize()
+    # profile: a SqliteProfile, or the name of one in SQLITE_PROFILES
+    def __init__(self,output_name,mapping,batch_size=10000,spatial_index=False,profile='default'):
+        self.path = output_name + '.gpkg'
+        self.batch_size = batch_size
+        self.spatial_index = spatial_index
+        self.profile = SQLITE_PROFILES[profile] if isinstance(profile,str) else profile
+        self.written = 0
+        self.timers = {}
         driver = ogr.GetDriverByName('GPKG')
-        self.ds = driver.CreateDataSource(output_name + '.gpkg')
-        self.ds.StartTransaction()
+        ds = driver.CreateDataSource(self.path)
 
-        self.files = [File('gpkg',[output_name + '.gpkg'])]
+        self.files = [File('gpkg',[self.path])]
         self.layers = {}
+        self.unique_layers = []
         for theme in mapping.themes:
-            layer = Geopackage.Layer(self.ds,theme)
+            layer = Geopackage.Layer(ds,theme)
+            self.unique_layers.append(layer)
             if theme.points:
                 self.layers[(theme.name,GeomType.POINT)] = layer
             if theme.lines:
                 self.layers[(theme.name,GeomType.LINE)] = layer
             if theme.polygons:
                 self.layers[(theme.name,GeomType.POLYGON)] = layer
+        ds = None
+
+        # check_same_thread: may be written from a ThreadedOutput thread
+        self.conn = sqlite3.connect(self.path,isolation_level=None,check_same_thread=False)
+        for statement in self.profile.load_statements():
+            self.conn.execute(statement)
+        self.conn.execute('BEGIN')
 
-    def write(self,osm_id,layer_name,geom_type,geom,tags):
+    def flush(self,layer):
+        self.conn.executemany(layer.sql,layer.rows)
+        layer.rows = []
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
         layer = self.layers[(layer_name,geom_type)]
-        feature = ogr.Feature(layer.defn)
-        feature.SetGeometry(geom)
-        if layer.osm_id:
-            feature.SetField('osm_id',osm_id)
-        for column_name in layer.columns:
-            if column_name in tags:
-                feature.SetField(column_name,tags[column_name])
-        layer.ogr_layer.CreateFeature(feature)
+        layer.rows.append(layer.row(osm_id,geom,values))
+        if len(layer.rows) >= self.batch_size:
+            self.flush(layer)
+        self.written += 1
+        if self.profile.commit_every and self.written % self.profile.commit_every == 0:
+            for unique_layer in self.unique_layers:
+                self.flush(unique_layer)
+            self.conn.execute('COMMIT')
+            self.conn.execute('BEGIN')
 
     def finalize(self):
-        self.ds.CommitTransaction()
+        for layer in self.unique_layers:
+            self.flush(layer)
+        self.conn.execute('COMMIT')
+        self.conn.close()
+        self.conn = None
+
+        # extents in gpkg_contents are left empty by the direct inserts
+        ds = ogr.Open(self.path,1)
+        for layer in self.unique_layers:
+            execute_sql(ds,'RECOMPUTE EXTENT ON ' + layer.table)
+        if self.spatial_index:
+            start = time.perf_counter()
+            for layer in self.unique_layers:
+                create_spatial_index(ds,layer.table,layer.geometry_column)
+            self.timers['spatial_index'] = time.perf_counter() - start
+        ds = None
+
+        statements = self.profile.finish_statements()
+        if statements:
+            start = time.perf_counter()
+            conn = sqlite3.connect(self.path,isolation_level=None)
+            for statement in statements:
+                conn.execute(statement)
+            conn.close()
+            self.timers['optimize'] = time.perf_counter() - start
         self.layers = None
-        self.ds = None
+        self.unique_layers = None
 
 # special case where each theme is a separate geopackage, for legacy reasons
 class MultiGeopackage:
+    """ One GeoPackage per theme. With threaded, each theme's file is written
+        and finalized by its own ThreadedOutput, so the themes' SQLite writes,
+        commits and index builds run concurrently. With spatial_index, each file gets an R-tree in finalize().
+        profile is a SqliteProfile, or the name of one in SQLITE_PROFILES. """
+
     class Layer:
-        def __init__(self,output_name,theme):
+        def __init__(self,output_name,theme,spatial_index=False,profile=SQLITE_PROFILES['default']):
+            self.spatial_index = spatial_index
+            self.profile = profile
+            self.written = 0
+            self.timers = {}
             driver = ogr.GetDriverByName('GPKG')
             self.ds = driver.CreateDataSource(output_name + '_' + make_filename(theme.name) + '.gpkg')
+            for statement in profile.load_statements():
+                execute_sql(self.ds,statement)
             self.ds.StartTransaction()
             self.ogr_layer = self.ds.CreateLayer(theme.name, epsg_4326, ogr.wkbUnknown,options=['SPATIAL_INDEX=NO'])
 
             if theme.osm_id:
                 self.osm_id = True
-                field_name = ogr.FieldDefn('osm_id', ogr.OFTInteger64)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
+                self.ogr_layer.CreateField(ogr.FieldDefn('osm_id', ogr.OFTInteger64))
             else:
                 self.osm_id = False
+            # index of the first column field
+            self.offset = 1 if self.osm_id else 0
 
-            self.columns = theme.keys
-            for column_name in self.columns:
-                field_name = ogr.FieldDefn(column_name, ogr.OFTString)
-                field_name.SetWidth(80)
-                self.ogr_layer.CreateField(field_name)
+            self.columns = theme.columns
+            for field in theme.fields:
+                self.ogr_layer.CreateField(field_defn(field.name,field))
             self.defn = self.ogr_layer.GetLayerDefn()
 
-    def __init__(self,output_name,mapping):
+        def write(self,osm_id,layer_name,geom_type,geom,values):
+            feature = ogr.Feature(self.defn)
+            feature.SetGeometry(geom.ogr)
+            if self.osm_id:
+                feature.SetField(0,osm_id)
+            for i, value in enumerate(values,self.offset):
+                if value is not None:
+                    feature.SetField(i,value)
+            self.ogr_layer.CreateFeature(feature)
+            self.written += 1
+            if self.profile.commit_every and self.written % self.profile.commit_every == 0:
+                self.ds.CommitTransaction()
+                self.ds.StartTransaction()
+
+        def finalize(self):
+            self.ds.CommitTransaction()
+            if self.spatial_index:
+                start = time.perf_counter()
+                create_spatial_index(self.ds,self.ogr_layer.GetName(),self.ogr_layer.GetGeometryColumn())
+                self.timers['spatial_index'] = time.perf_counter() - start
+            statements = self.profile.finish_statements()
+            if statements:
+                start = time.perf_counter()
+                for statement in statements:
+                    execute_sql(self.ds,statement)
+                self.timers['optimize'] = time.perf_counter() - start
+            self.ds = None
+
+    def __init__(self,output_name,mapping,threaded=False,spatial_index=False,profile='default'):
         self.files = []
         self.layers = {}
+        self.unique_layers = []
+        self.theme_layers = []
+        self.timers = {}
+        if isinstance(profile,str):
+            profile = SQLITE_PROFILES[profile]
         for theme in mapping.themes:
-            layer = MultiGeopackage.Layer(output_name, theme)
+            theme_layer = MultiGeopackage.Layer(output_name,theme,spatial_index,profile)
+            self.theme_layers.append(theme_layer)
+            layer = ThreadedOutput(theme_layer) if threaded else theme_layer
+            self.unique_layers.append(layer)
             self.files.append(File('gpkg',[output_name + '_' + make_filename(theme.name) + '.gpkg'],{'theme':theme.name}))
             if theme.points:
                 self.layers[(theme.name,GeomType.POINT)] = layer
@@ -232,110 +453,579 @@ class MultiGeopackage:
             if theme.polygons:
                 self.layers[(theme.name,GeomType.POLYGON)] = layer
 
-    def write(self,osm_id,layer_name,geom_type,geom,tags):
-        layer = self.layers[(layer_name,geom_type)]
-        feature = ogr.Feature(layer.defn)
-        feature.SetGeometry(geom)
-        if layer.osm_id:
-            feature.SetField('osm_id',osm_id)
-        for column_name in layer.columns:
-            if column_name in tags:
-                feature.SetField(column_name,tags[column_name])
-        layer.ogr_layer.CreateFeature(feature)
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        self.layers[(layer_name,geom_type)].write(osm_id,layer_name,geom_type,geom,values)
 
     def finalize(self):
-        for k, layer in self.layers.items():
-            layer.ds.CommitTransaction()
+        # end the input of every theme first, so that their final commits,
+        # spatial indexes and optimizations run concurrently on their threads.
+        for layer in self.unique_layers:
+            if isinstance(layer,ThreadedOutput):
+                layer.close()
+        for layer in self.unique_layers:
+            layer.finalize()
+        for layer in self.theme_layers:
+            for stage, seconds in layer.timers.items():
+                self.timers[stage] = self.timers.get(stage,0.0) + seconds
         self.layers = None
+        self.unique_layers = None
+        self.theme_layers = None
+
+class ThreadedOutput:
+    """ Runs the writes of an output on its own thread, behind a bounded queue.
+
+        Features are handed to the thread in batches, in the order they were written,
+        so every layer receives them in the same order as without a thread.
+        When maxsize batches are waiting, write() blocks until the thread catches up.
+        The output is finalized on the thread too, after the last batch; close()
+        ends the input without waiting, so several outputs can finalize at once.
+        An error in the thread is raised from the next write() or from finalize(). """
+
+    def __init__(self,output,batch_size=256,maxsize=16):
+        self.output = output
+        self.batch_size = batch_size
+        self.batch = []
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    @property
+    def files(self):
+        return self.output.files
+
+    @property
+    def timers(self):
+        return getattr(self.output,'timers',{})
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error:
+                continue # keep draining, so write() never blocks on a dead thread
+            try:
+                for args in batch:
+                    self.output.write(*args)
+            except Exception as e:
+                self.error = e
+        if not self.error:
+            try:
+                self.output.finalize()
+            except Exception as e:
+                self.error = e
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        self.batch.append((osm_id,layer_name,geom_type,geom,values))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.error:
+            raise self.error
+        self.queue.put(self.batch)
+        self.batch = []
+
+    # ends the input; the thread then writes what is queued and finalizes the output.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+
+    def finalize(self):
+        self.close()
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+# buffers features in a file, so they can be written to the real outputs
+# by another process. see apply_file_parallel.
+class Spool:
+    def __init__(self,output_name,mapping):
+        self.path = output_name + '.spool'
+        self.f = open(self.path,'wb')
+        self.files = [File('spool',[self.path])]
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        self.f.write(pickle.dumps((osm_id,layer_name,geom_type.value,geom.wkb,values),pickle.HIGHEST_PROTOCOL))
+
+    def finalize(self):
+        self.f.close()
+
+    @staticmethod
+    def replay(path,outputs):
+        with open(path,'rb') as f:
+            while True:
+                try:
+                    osm_id, layer_name, geom_type, wkb, values = pickle.load(f)
+                except EOFError:
+                    break
+                geom = Geometry(wkb)
+                for output in outputs:
+                    output.write(osm_id,layer_name,GeomType(geom_type),geom,values)
+
+def _export_partition(args):
+    osm_file, output_name, mapping, clipping_geom, polygon_centroid, partition, idx, stats = args
+    spool = Spool(output_name,mapping)
+    h = Handler([spool],mapping,clipping_geom=clipping_geom,polygon_centroid=polygon_centroid,partition=partition,stats=stats)
+    h.apply_file(osm_file, locations=True, idx=idx, index_filled=True)
+    spool.finalize()
+    return spool.path, stats
+
+def apply_file_parallel(osm_file,outputs,mapping,workers,tempdir,clipping_geom=None,polygon_centroid=False,stats=None):
+    """ Runs Handler over osm_file in worker processes.
+
+        Each worker reads the whole file but only handles the nodes, ways and areas
+        whose id falls in its partition (id modulo workers), so every object,
+        including multipolygons, is handled by exactly one worker.
+        Node locations are indexed once, into a dense file array that the workers
+        only read.
+        The features of each worker are written to outputs in worker order,
+        as soon as that worker is done. Worker stats are merged into stats. """
+    index_path = os.path.join(tempdir,'locations.idx')
+    idx = 'dense_file_array,' + index_path
+    # fill the index up front, so workers never grow the shared file
+    locations = o.index.create_map(idx)
+    o.apply(o.io.Reader(osm_file,o.osm.osm_entity_bits.NODE),o.NodeLocationsForWays(locations))
+    if stats:
+        stats.record_index(idx,locations)
+    del locations
+
+    args = [(osm_file,os.path.join(tempdir,'partition_{0}'.format(i)),mapping,clipping_geom,polygon_centroid,(i,workers),idx,Stats() if stats else None) for i in range(workers)]
+    if stats:
+        outputs = [Stats.Output(output,stats) for output in outputs]
+    # spawned, not forked: the caller may have writer threads and open SQLite
+    # connections, which a forked child would inherit in an undefined state.
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for path, worker_stats in pool.imap(_export_partition,args):
+            if stats:
+                stats.merge(worker_stats)
+            Spool.replay(path,outputs)
+            os.remove(path)
+    os.remove(index_path)
+
+# the name outputs are reported under; a ThreadedOutput under its output's.
+def output_name(output):
+    if isinstance(output,ThreadedOutput):
+        output = output.output
+    return type(output).__name__
+
+class Stats:
+    """ Counters and per-stage timers collected by a Handler.
+
+        Collection is enabled by passing a Stats to Handler, which then wraps
+        its matching, geometry, clipping and output steps; without one,
+        Handler runs unwrapped. """
+
+    def __init__(self):
+        self.seen = {t.name.lower():0 for t in GeomType}
+        self.matched = {}
+        self.clipped = 0
+        self.rejected = 0
+        self.prefiltered = 0
+        self.skipped_no_key = 0
+        self.unparsed = {}
+        self.incomplete_ways = 0
+        self.invalid_areas = 0
+        self.features = {}
+        self.bytes_written = {}
+        self.timers = {}
+        self.location_index = None
+
+    def timed(self,stage,fn):
+        timers = self.timers
+        timers.setdefault(stage,0.0)
+        def wrapper(*args):
+            start = time.perf_counter()
+            result = fn(*args)
+            timers[stage] += time.perf_counter() - start
+            return result
+        return wrapper
+
+    def instrument(self,handler):
+        seen = self.seen
+        matched = self.matched
+        match = self.timed('match',handler.matching_themes)
+        def matching_themes(geom_type,tags):
+            themes = match(geom_type,tags)
+            seen[geom_type.name.lower()] += 1
+            for theme in themes:
+                key = (theme.name,geom_type.name.lower())
+                matched[key] = matched.get(key,0) + 1
+            return themes
+        handler.matching_themes = matching_themes
+
+        # objects skipped before matching, since no theme can select them
+        def counted_has_relevant_key(tags,keys):
+            result = has_relevant_key(tags,keys)
+            if not result:
+                self.skipped_no_key += 1
+            return result
+        handler.has_relevant_key = counted_has_relevant_key
+
+        # values dropped from columns of an inferred type, which the mapping
+        # didn't ask for, so that they aren't lost silently
+        unparsed = self.unparsed
+        values = handler.theme_values
+        def counted_theme_values(theme,tags):
+            result = values(theme,tags)
+            for column in theme.unparsed(tags,result):
+                key = (theme.name,column)
+                unparsed[key] = unparsed.get(key,0) + 1
+            return result
+        handler.theme_values = counted_theme_values
+
+        handler.point_wkb = self.timed('geometry',handler.point_wkb)
+        handler.linestring_wkb = self.timed('geometry',handler.linestring_wkb)
+        handler.multipolygon_wkb = self.timed('geometry',handler.multipolygon_wkb)
+
+        outside_bounds = self.timed('prefilter',handler.outside_bounds)
+        def counted_outside_bounds(locations):
+            result = outside_bounds(locations)
+            if result:
+                self.prefiltered += 1
+            return result
+        handler.outside_bounds = counted_outside_bounds
+
+        contains_point = self.timed('clip',handler.contains_point)
+        def counted_contains_point(location):
+            result = contains_point(location)
+            if not result:
+                self.rejected += 1
+            return result
+        handler.contains_point = counted_contains_point
+
+        clip = self.timed('clip',handler.clip)
+        def counted_clip(wkb):
+            result = clip(wkb)
+            if result is None:
+                self.rejected += 1
+            elif result is not wkb:
+                self.clipped += 1
+            return result
+        handler.clip = counted_clip
+
+        handler.outputs = [Stats.Output(output,self) for output in handler.outputs]
+
+    class Output:
+        def __init__(self,output,stats):
+            self.name = output_name(output)
+            self.output_write = stats.timed('write:' + self.name,output.write)
+            self.features = stats.features
+            self.features.setdefault(self.name,0)
+
+        def write(self,osm_id,layer_name,geom_type,geom,values):
+            self.output_write(osm_id,layer_name,geom_type,geom,values)
+            self.features[self.name] += 1
+
+    def record_index(self,idx,index):
+        self.location_index = {'type':idx.split(',')[0],'bytes':index.used_memory()}
+
+    # times finalize() of each output, and records the size of its files.
+    def finalize(self,outputs):
+        for output in outputs:
+            name = output_name(output)
+            self.timed('finalize:' + name,output.finalize)()
+            self.bytes_written[name] = sum(f.size() for f in output.files)
+            # stages within finalize, e.g. the spatial index build
+            for stage, seconds in getattr(output,'timers',{}).items():
+                self.timers[stage + ':' + name] = seconds
+
+    def merge(self,other):
+        for k, v in other.seen.items():
+            self.seen[k] += v
+        for k, v in other.matched.items():
+            self.matched[k] = self.matched.get(k,0) + v
+        for k, v in other.unparsed.items():
+            self.unparsed[k] = self.unparsed.get(k,0) + v
+        for k, v in other.timers.items():
+            self.timers[k] = self.timers.get(k,0.0) + v
+        self.clipped += other.clipped
+        self.rejected += other.rejected
+        self.prefiltered += other.prefiltered
+        self.skipped_no_key += other.skipped_no_key
+        self.incomplete_ways += other.incomplete_ways
+        self.invalid_areas += other.invalid_areas
+        self.location_index = self.location_index or other.location_index
+
+    def to_dict(self):
+        matched = {}
+        for (theme_name, geom_type), count in self.matched.items():
+            matched.setdefault(theme_name,{})[geom_type] = count
+        unparsed = {}
+        for (theme_name, column), count in self.unparsed.items():
+            unparsed.setdefault(theme_name,{})[column] = count
+        return {
+            'seen':self.seen,
+            'matched':matched,
+            'clipped':self.clipped,
+            'rejected':self.rejected,
+            'prefiltered':self.prefiltered,
+            'skipped_no_key':self.skipped_no_key,
+            'unparsed':unparsed,
+            'incomplete_ways':self.incomplete_ways,
+            'invalid_areas':self.invalid_areas,
+            'features':self.features,
+            'bytes_written':self.bytes_written,
+            'location_index':self.location_index,
+            'timers':self.timers
+        }
+
+# PBF input sizes above which a different node location index pays off.
+# flex_mem keeps everything in memory, switching from sparse to dense itself.
+# up to continent-sized extracts a sparse array (16 bytes per node) is smaller;
+# beyond that, a dense array (8 bytes per node id) is smaller and faster.
+LOCATION_INDEX_IN_MEMORY = 1 << 30
+LOCATION_INDEX_SPARSE = 8 << 30
+
+def location_index_type(osm_file,on_disk=False):
+    """ Chooses a node location index type for osm_file from its size.
+        If on_disk, large indexes are file arrays instead of anonymous mmaps,
+        and need a file name appended, see Handler.apply_file. """
+    size = os.path.getsize(osm_file)
+    if osm_file.endswith(('.osm','.xml')):
+        size = size // 10 # uncompressed XML is roughly ten times larger than PBF
+    if size <= LOCATION_INDEX_IN_MEMORY:
+        return 'flex_mem'
+    if size <= LOCATION_INDEX_SPARSE:
+        return 'sparse_file_array' if on_disk else 'sparse_mmap_array'
+    return 'dense_file_array' if on_disk else 'dense_mmap_array'
+
+class AreaCandidates:
+    """ Filter for the two passes of area assembly, see Handler.apply_file.
+
+        In the first pass over relations, it drops multipolygons whose tags
+        can't match a polygon theme, and records the member ways of the others.
+        In the second pass, it drops ways that are neither such a member nor
+        a closed way that can match a polygon theme, so they are never assembled.
+        A handler method returning True drops the object from the chain. """
+
+    def __init__(self,polygon_keys,partition=None):
+        self.polygon_keys = polygon_keys
+        self.partition = partition
+        self.member_ways = o.index.IdSet()
+
+    # same test as Handler.area, before assembly. area ids are 2 * id for
+    # ways and 2 * id + 1 for relations.
+    def can_match(self,area_id,tags):
+        if self.partition and area_id % self.partition[1] != self.partition[0]:
+            return False
+        return has_relevant_key(tags,self.polygon_keys) and closed_way_is_polygon(tags)
+
+    def relation(self,r):
+        if r.tags.get('type') not in ('multipolygon','boundary'):
+            return True
+        if not self.can_match(2 * r.id + 1,r.tags):
+            return True
+        for member in r.members:
+            if member.type == 'w':
+                self.member_ways.set(member.ref)
+        return False
+
+    def way(self,w):
+        if w.id in self.member_ways:
+            return False
+        return not (w.is_closed() and len(w.tags) > 0 and self.can_match(2 * w.id,w.tags))
 
 class Handler(o.SimpleHandler):
-    def __init__(self,outputs,mapping,clipping_geom=None, polygon_centroid=False):
+    def __init__(self,outputs,mapping,clipping_geom=None, polygon_centroid=False, partition=None, stats=None):
         super(Handler, self).__init__()
         self.outputs = outputs
         self.mapping = mapping
         self.clipping_geom = clipping_geom
         self.polygon_centroid = polygon_centroid
 
+        # (index, count): only handle objects where id % count == index
+        self.partition = partition
+
+        # objects with none of these keys can't match any theme
+        self.point_keys = mapping.relevant_keys(GeomType.POINT)
+        self.line_keys = mapping.relevant_keys(GeomType.LINE)
+        self.polygon_keys = mapping.relevant_keys(GeomType.POLYGON)
+
         if clipping_geom:
-            self.prepared_clipping_geom=None
-            self.prepared_clipping_geom = prep(clipping_geom)
+            self.clipping_grid = ClippingGrid(clipping_geom)
+            self.clipping_bounds = clipping_geom.bounds
+
+        # steps that Stats.instrument can wrap
+        self.has_relevant_key = has_relevant_key
+        self.matching_themes = mapping.matching_themes
+        self.theme_values = theme_values
+        self.point_wkb = point_wkb
+        self.linestring_wkb = linestring_wkb
+        self.multipolygon_wkb = multipolygon_wkb
+
+        self.stats = stats
+        if stats:
+            stats.instrument(self)
+
+    # like SimpleHandler.apply_file with locations, but only relations and
+    # closed ways that can match a polygon theme are assembled into areas.
+    # idx defaults to location_index_type(filename); file array indexes
+    # without a file name get a temporary one in index_dir. if index_filled,
+    # idx already holds every node location and is only read, not written.
+    # without locations there is no index, so ways and areas would have no
+    # geometry: only nodes are read, for points.
+    def apply_file(self,filename,locations=True,idx=None,index_dir=None,index_filled=False):
+        if not locations:
+            with o.io.Reader(filename,o.osm.osm_entity_bits.NODE) as reader:
+                o.apply(reader,self)
+            return
+        if idx is None:
+            idx = location_index_type(filename,on_disk=index_dir is not None)
+        index_path = None
+        if idx in ('sparse_file_array','dense_file_array') and index_dir:
+            fd, index_path = tempfile.mkstemp(suffix='.idx',dir=index_dir)
+            os.close(fd)
+            idx = idx + ',' + index_path
+        try:
+            candidates = AreaCandidates(self.polygon_keys,self.partition)
+            area = o.area.AreaManager()
+            with o.io.Reader(filename,o.osm.osm_entity_bits.RELATION) as reader:
+                o.apply(reader,candidates,area.first_pass_handler())
+
+            index = o.index.create_map(idx)
+            lh = o.NodeLocationsForWays(index)
+            lh.ignore_errors()
+            handlers = [lh,self,candidates,area.second_pass_handler(self)]
+            if index_filled:
+                # nodes are only handled for points, and dropped before lh
+                handlers = [o.make_simple_handler(node=self.node),o.filter.EntityFilter(o.osm.osm_entity_bits.WAY)] + handlers
+            with o.io.Reader(filename,o.osm.osm_entity_bits.NODE | o.osm.osm_entity_bits.WAY) as reader:
+                o.apply(reader,*handlers)
+            if self.stats:
+                self.stats.record_index(idx,index)
+        finally:
+            if index_path:
+                os.remove(index_path)
 
     def node(self,n):
         if len(n.tags) == 0:
             return
+        if self.partition and n.id % self.partition[1] != self.partition[0]:
+            return
+        if not self.has_relevant_key(n.tags,self.point_keys):
+            return
+        if self.clipping_geom and self.outside_bounds((n.location,)):
+            return
+        tags = tags_dict(n.tags)
         geom = None
-        for theme in self.mapping.themes:
-            if theme.matches(GeomType.POINT,n.tags):
-                if not geom:
-                    wkb = fab.create_point(n)
-                    if self.clipping_geom:
-                        sg = loads(bytes.fromhex(wkb))
-                        if not self.prepared_clipping_geom.contains(sg):
-                            return
-                    geom = create_geom(wkb)
-                for output in self.outputs:
-                    output.write(n.id,theme.name,GeomType.POINT,geom,n.tags)
+        for theme in self.matching_themes(GeomType.POINT,tags):
+            if not geom:
+                location = n.location
+                if self.clipping_geom:
+                    if not self.contains_point(location):
+                        return
+                geom = Geometry(self.point_wkb(location))
+            values = self.theme_values(theme,tags)
+            for output in self.outputs:
+                output.write(n.id,theme.name,GeomType.POINT,geom,values)
+
+    # cheap rejection before any geometry is built: true if the bounding box
+    # of locations (anything with lon and lat) is disjoint from the clipping geom's.
+    # stops at the first location inside the bounds.
+    def outside_bounds(self,locations):
+        minx, miny, maxx, maxy = self.clipping_bounds
+        west = east = south = north = True
+        for l in locations:
+            lon, lat = l.lon, l.lat
+            west = west and lon < minx
+            east = east and lon > maxx
+            south = south and lat < miny
+            north = north and lat > maxy
+            if not (west or east or south or north):
+                return False
+        return True
+
+    def contains_point(self,location):
+        return self.clipping_grid.contains_point(location.lon,location.lat)
+
+    # clips binary wkb; returns None if it is outside the clipping geom.
+    # only geometries crossing the boundary are re-serialized.
+    def clip(self,wkb):
+        sg = loads(wkb)
+        clipped = self.clipping_grid.clip(sg)
+        if clipped is None:
+            return None
+        if clipped is sg:
+            return wkb
+        return dumps(clipped)
 
     def way(self, w):
         if len(w.tags) == 0:
             return
+        if self.partition and w.id % self.partition[1] != self.partition[0]:
+            return
         if w.is_closed() and closed_way_is_polygon(w.tags): # this will be handled in area()
             return
+        if not self.has_relevant_key(w.tags,self.line_keys):
+            return
+        tags = tags_dict(w.tags)
         try:
             # NOTE: it is possible this is actually a MultiLineString
             # in the case where a LineString is clipped by the clipping geom,
             # or the way is self-intersecting
             # but GDAL and QGIS seem to handle it OK.
             linestring = None
-            for theme in self.mapping.themes:
-                if theme.matches(GeomType.LINE,w.tags):
-                    if not linestring:
-                        wkb = fab.create_linestring(w)
-                        if self.clipping_geom:
-                            sg = loads(bytes.fromhex(wkb))
-                            if not self.prepared_clipping_geom.intersects(sg):
-                                return
-                            if not self.prepared_clipping_geom.contains_properly(sg):
-                                sg = self.clipping_geom.intersection(sg)
-                            linestring = ogr.CreateGeometryFromWkb(dumps(sg))
-                        else:
-                            linestring = create_geom(wkb)
-                    for output in self.outputs:
-                        output.write(w.id,theme.name,GeomType.LINE,linestring,w.tags)
-        except RuntimeError:
+            for theme in self.matching_themes(GeomType.LINE,tags):
+                if not linestring:
+                    if self.clipping_geom and self.outside_bounds(w.nodes):
+                        return
+                    wkb = self.linestring_wkb(w)
+                    if self.clipping_geom:
+                        wkb = self.clip(wkb)
+                        if wkb is None:
+                            return
+                    linestring = Geometry(wkb)
+                values = self.theme_values(theme,tags)
+                for output in self.outputs:
+                    output.write(w.id,theme.name,GeomType.LINE,linestring,values)
+        except (RuntimeError, o.InvalidLocationError):
+            if self.stats:
+                self.stats.incomplete_ways += 1
             print("Incomplete way: {0}".format(w.id))
 
     def area(self,a):
         if len(a.tags) == 0:
             return
-        if not closed_way_is_polygon(a.tags):
+        if self.partition and a.id % self.partition[1] != self.partition[0]:
+            return
+        if not self.has_relevant_key(a.tags,self.polygon_keys):
+            return
+        tags = tags_dict(a.tags)
+        if not closed_way_is_polygon(tags):
             return
         osm_id = a.orig_id() if a.from_way() else -a.orig_id()
         try:
             geom_type = GeomType.POLYGON
             multipolygon = None
-            for theme in self.mapping.themes:
-                if theme.matches(GeomType.POLYGON,a.tags):
-                    if not multipolygon:
-                        wkb = fab.create_multipolygon(a)
-                        if self.clipping_geom:
-                            sg = loads(bytes.fromhex(wkb))
-                            if not self.prepared_clipping_geom.intersects(sg):
-                                return
-                            if not self.prepared_clipping_geom.contains_properly(sg):
-                                sg = self.clipping_geom.intersection(sg)
-                            multipolygon = ogr.CreateGeometryFromWkb(dumps(sg))
-                        else:
-                            multipolygon = create_geom(wkb)
-
-                        geom = multipolygon
-                        if self.polygon_centroid is True:
-                            geom = multipolygon.Centroid()
-                            geom_type = GeomType.POINT
-
-                    for output in self.outputs:
-                        output.write(osm_id,theme.name,geom_type,geom,a.tags)
-        except RuntimeError:
-            print('Invalid area: {0}'.format(a.orig_id()))
+            for theme in self.matching_themes(GeomType.POLYGON,tags):
+                if not multipolygon:
+                    if self.clipping_geom and self.outside_bounds(n for ring in a.outer_rings() for n in ring):
+                        return
+                    wkb = self.multipolygon_wkb(a)
+                    if self.clipping_geom:
+                        wkb = self.clip(wkb)
+                        if wkb is None:
+                            return
+                    multipolygon = Geometry(wkb)
 
+                    geom = multipolygon
+                    if self.polygon_centroid is True:
+                        centroid = multipolygon.ogr.Centroid()
+                        geom = Geometry(bytes(centroid.ExportToWkb(ogr.wkbNDR)),centroid)
+                        geom_type = GeomType.POINT
 
+                values = self.theme_values(theme,tags)
+                for output in self.outputs:
+                    output.write(osm_id,theme.name,geom_type,geom,values)
+        except RuntimeError:
+            if self.stats:
+                self.stats.invalid_areas += 1
+            print('Invalid area: {0}'.format(a.orig_id()))
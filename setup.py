@@ -4,7 +4,7 @@ with open("README.md", "r") as fh:
     long_description = fh.read()
 
 requirements = [
-    "osmium~=3.5.0",
+    "osmium~=4.0",
     "pyparsing~=2.4",
     "pyyaml",
     "shapely~=1.6",
@@ -0,0 +1,77 @@
+import math
+import random
+import unittest
+from shapely.geometry import LineString, Point, Polygon
+from osm_export_tool.geometry import ClippingGrid
+
+class TestClippingGrid(unittest.TestCase):
+    def setUp(self):
+        # a star-shaped boundary with many vertices, so it is split into cells
+        rand = random.Random(0)
+        coords = []
+        for i in range(2000):
+            angle = i / 2000.0 * 6.283185307179586
+            r = 1.0 + rand.uniform(-0.2,0.2)
+            coords.append((r * math.cos(angle),r * math.sin(angle)))
+        self.geom = Polygon(coords)
+        self.grid = ClippingGrid(self.geom)
+        self.rand = rand
+
+    def test_grid(self):
+        self.assertTrue(self.grid.n > 1)
+        self.assertIn(ClippingGrid.INSIDE,self.grid.status.values())
+        self.assertIn(ClippingGrid.BOUNDARY,self.grid.status.values())
+
+    def test_points(self):
+        for i in range(2000):
+            x, y = self.rand.uniform(-1.5,1.5), self.rand.uniform(-1.5,1.5)
+            self.assertEqual(self.grid.contains_point(x,y),self.geom.contains(Point(x,y)))
+
+    def test_lines(self):
+        for i in range(300):
+            x, y = self.rand.uniform(-1.5,1.5), self.rand.uniform(-1.5,1.5)
+            line = LineString([(x,y),(x + self.rand.uniform(-0.5,0.5),y + self.rand.uniform(-0.5,0.5))])
+            clipped = self.grid.clip(line)
+            if not self.geom.intersects(line):
+                self.assertIsNone(clipped)
+            elif self.geom.contains_properly(line):
+                self.assertIs(clipped,line)
+            else:
+                self.assertAlmostEqual(clipped.length,self.geom.intersection(line).length)
+
+    def test_polygons(self):
+        for i in range(300):
+            x, y = self.rand.uniform(-1.5,1.5), self.rand.uniform(-1.5,1.5)
+            size = self.rand.uniform(0.001,0.3)
+            polygon = Polygon([(x,y),(x + size,y),(x + size,y + size),(x,y + size)])
+            clipped = self.grid.clip(polygon)
+            if not self.geom.intersects(polygon):
+                self.assertIsNone(clipped)
+            else:
+                self.assertAlmostEqual(clipped.area,self.geom.intersection(polygon).area)
+
+    def test_large_features(self):
+        # features covering more than MAX_LOCAL_CELLS cells are clipped against
+        # the whole prepared geometry, without building a local one.
+        local_geom = self.grid._local_geom
+        def no_local_geom(pieces):
+            self.fail('local geometry built for a large feature')
+        self.grid._local_geom = no_local_geom
+        for i in range(300):
+            x, y = self.rand.uniform(-1.5,1.5), self.rand.uniform(-1.5,1.5)
+            line = LineString([(x,y),(x + self.rand.uniform(-3,3),y + self.rand.uniform(-3,3))])
+            key, beyond = self.grid._cells(line.bounds)
+            if key is not None and (key[1] - key[0] + 1) * (key[3] - key[2] + 1) <= ClippingGrid.MAX_LOCAL_CELLS:
+                continue
+            clipped = self.grid.clip(line)
+            if not self.geom.intersects(line):
+                self.assertIsNone(clipped)
+            else:
+                self.assertAlmostEqual(clipped.length,self.geom.intersection(line).length)
+        self.grid._local_geom = local_geom
+        # the cache holds at most one local geometry per boundary cell
+        for i in range(300):
+            x, y = self.rand.uniform(-1.5,1.5), self.rand.uniform(-1.5,1.5)
+            self.grid.clip(LineString([(x,y),(x + self.rand.uniform(-0.2,0.2),y + self.rand.uniform(-0.2,0.2))]))
+        self.assertTrue(self.grid._local)
+        self.assertLessEqual(len(self.grid._local),len(self.grid.pieces) + 1)
@@ -1,6 +1,9 @@
+import os
+import random
 import unittest
 from osm_export_tool.mapping import Mapping
 from osm_export_tool import GeomType
+from osm_export_tool.sql import _match
 
 class TestMapping(unittest.TestCase):
     def test_basic_mapping(self):
@@ -161,6 +164,75 @@ class TestMapping(unittest.TestCase):
         self.assertTrue(m.themes[0].osm_id)
         self.assertFalse('osm_id' in m.themes[0].keys)
 
+    def test_columns_order(self):
+        y = '''
+        buildings:
+          select:
+            - name
+            - osm_id
+            - building
+            - addr:street
+            - name
+        '''
+        m = Mapping(y)
+        self.assertEqual(m.themes[0].columns,['name','building','addr:street'])
+
+    def test_column_types(self):
+        y = '''
+        buildings:
+          select:
+            - name
+            - building:levels
+            - height: {type: real}
+            - name:
+                width: 20
+            - addr:housenumber:
+                type: string
+                width: 10
+        '''
+        m = Mapping(y)
+        theme = m.themes[0]
+        self.assertEqual(theme.columns,['name','building:levels','height','addr:housenumber'])
+        self.assertEqual([(f.type,f.width) for f in theme.fields],[('string',None),('real',None),('real',None),('string',10)])
+        self.assertEqual([f.inferred for f in theme.fields],[False,True,False,False])
+        self.assertEqual(theme.keys,{'name','building:levels','height','addr:housenumber'})
+        values = theme.values({'name':'x','building:levels':'2','height':'10 m','addr:housenumber':'4a'})
+        self.assertEqual(values,['x',2.0,None,'4a'])
+        self.assertEqual(theme.values({'building:levels':'2.5','height':'12.5'}),[None,2.5,12.5,None])
+        self.assertEqual(theme.values({'building:levels':'nan','height':'nan'}),[None,None,None,None])
+
+    def test_unparsed(self):
+        y = '''
+        buildings:
+          select:
+            - building:levels
+            - height: {type: real}
+            - population
+        '''
+        theme = Mapping(y).themes[0]
+        tags = {'building:levels':'2;3','height':'10 m','population':'1200'}
+        # only columns of an inferred type are reported
+        self.assertEqual(theme.unparsed(tags,theme.values(tags)),['building:levels'])
+        tags = {'building:levels':'2','population':'about 50'}
+        self.assertEqual(theme.unparsed(tags,theme.values(tags)),['population'])
+
+    def test_integer(self):
+        y = '''
+        places:
+          select:
+            - population
+        '''
+        theme = Mapping(y).themes[0]
+        self.assertEqual(theme.values({'population':'1200'}),[1200])
+        self.assertEqual(theme.values({'population':'1200.0'}),[1200])
+        self.assertEqual(theme.values({'population':'1200.5'}),[None])
+        # integers are exact, and null outside the 64-bit range
+        self.assertEqual(theme.values({'population':'12345678901234567891'}),[None])
+        self.assertEqual(theme.values({'population':'1e30'}),[None])
+        self.assertEqual(theme.values({'population':'9223372036854775807'}),[9223372036854775807])
+        self.assertEqual(theme.values({'population':'-9223372036854775808'}),[-9223372036854775808])
+        self.assertEqual(theme.values({'population':'1234567890123456789.0'}),[1234567890123456789])
+
     def test_duplicate_key(self):
         y = '''
         buildings:
@@ -184,6 +256,87 @@ class TestMapping(unittest.TestCase):
         m = Mapping(y)
         self.assertEqual(m.themes[0].extra,{'foo':{'bar':'baz'}})
 
+class TestMatchingThemes(unittest.TestCase):
+    def reference(self,mapping,geom_type,tags):
+        return [t for t in mapping.themes if t.matches(geom_type,tags) and _match(t.matcher.expr,tags)]
+
+    def test_key_and_value_dispatch(self):
+        y = '''
+        buildings:
+          types:
+            - polygons
+          select:
+            - building
+        schools:
+          select:
+            - name
+          where: amenity IN ('school','college') AND name IS NOT NULL
+        not_residential:
+          types:
+            - points
+          select:
+            - name
+          where: landuse != 'residential'
+        '''
+        m = Mapping(y)
+        self.assertEqual([t.name for t in m.matching_themes(GeomType.POLYGON,{'building':'yes'})],['buildings'])
+        self.assertEqual(m.matching_themes(GeomType.LINE,{'building':'yes'}),[])
+        self.assertEqual(m.matching_themes(GeomType.LINE,{'amenity':'school'}),[])
+        self.assertEqual([t.name for t in m.matching_themes(GeomType.LINE,{'amenity':'school','name':'x'})],['schools'])
+        self.assertEqual([t.name for t in m.matching_themes(GeomType.POINT,{'amenity':'college','name':'x'})],['schools','not_residential'])
+        self.assertEqual(m.matching_themes(GeomType.POINT,{'landuse':'residential'}),[])
+
+    def test_relevant_keys(self):
+        y = '''
+        buildings:
+          types:
+            - polygons
+          select:
+            - building
+        schools:
+          types:
+            - lines
+            - polygons
+          select:
+            - name
+          where: amenity IN ('school','college') AND name IS NOT NULL
+        not_residential:
+          types:
+            - points
+          select:
+            - name
+          where: landuse != 'residential'
+        '''
+        m = Mapping(y)
+        self.assertEqual(m.relevant_keys(GeomType.POLYGON),{'building','amenity'})
+        self.assertEqual(m.relevant_keys(GeomType.LINE),{'amenity'})
+        self.assertIsNone(m.relevant_keys(GeomType.POINT))
+
+    def test_bundled_mappings_equivalent(self):
+        mappings_dir = os.path.join(os.path.dirname(__file__),'..','osm_export_tool','mappings')
+        rand = random.Random(0)
+        for file_name in sorted(os.listdir(mappings_dir)):
+            with open(os.path.join(mappings_dir,file_name),'r') as f:
+                m = Mapping(f.read())
+            pairs = []
+            for theme in m.themes:
+                pairs += [(k,'yes') for k in sorted(theme.keys)]
+                for k, v in [(t[1],t[2]) for t in flatten(theme.matcher.expr) if len(t) == 3]:
+                    for value in (v if isinstance(v,list) else [v]):
+                        pairs.append((k,value))
+            for i in range(500):
+                tags = dict(rand.sample(pairs,rand.randint(1,min(4,len(pairs)))))
+                for geom_type in GeomType:
+                    self.assertEqual(m.matching_themes(geom_type,tags),self.reference(m,geom_type,tags),(file_name,tags))
+                    keys = m.relevant_keys(geom_type)
+                    if keys is not None and keys.isdisjoint(tags):
+                        self.assertEqual(self.reference(m,geom_type,tags),[],(file_name,tags))
+
+def flatten(expr):
+    if expr and expr[0] in ('and','or'):
+        return flatten(expr[1]) + flatten(expr[2])
+    return [expr]
+
 class TestMappingValidation(unittest.TestCase):
     def test_empty_yaml(self):
         y = '''
@@ -226,6 +379,26 @@ class TestMappingValidation(unittest.TestCase):
         self.assertTrue(m is None)
         self.assertTrue(len(errors) == 1)
 
+    def test_invalid_column_type(self):
+        y = '''
+        buildings:
+          select:
+            - height: {type: float}
+        '''
+        m, errors = Mapping.validate(y)
+        self.assertTrue(m is None)
+        self.assertTrue(len(errors) == 1)
+
+    def test_invalid_column_width(self):
+        y = '''
+        buildings:
+          select:
+            - name: {width: wide}
+        '''
+        m, errors = Mapping.validate(y)
+        self.assertTrue(m is None)
+        self.assertTrue(len(errors) == 1)
+
     def test_empty_sql(self):
         y = '''
         buildings:
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import tarfile
+import unittest
+import zipfile
+from shapely.geometry import box
+from osm_export_tool import File
+from osm_export_tool.package import Package, ParallelGzipWriter, create_package, create_posm_bundle, write_members
+
+class TestCreatePackage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        rand = random.Random(0)
+        self.contents = {
+            'empty.txt':b'',
+            'small.kml':b'<kml></kml>' * 10,
+            'text.gpkg':b''.join(rand.choice([b'building',b'highway',b'name',b'yes']) for i in range(200000)),
+            'random.dbf':bytes(rand.getrandbits(8) for i in range(100000)),
+            'extract.osm.pbf':b'pbf' * 1000
+        }
+        for name, data in self.contents.items():
+            with open(self.path(name),'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def path(self,name):
+        return os.path.join(self.tempdir,name)
+
+    def assertContents(self,destination):
+        with zipfile.ZipFile(destination) as z:
+            self.assertIsNone(z.testzip())
+            for name, data in self.contents.items():
+                self.assertEqual(z.read(name),data)
+
+    def test_create_package(self):
+        files = [File('gpkg',[self.path(name)]) for name in sorted(self.contents)]
+        destination = self.path('out.zip')
+        stats = {}
+        create_package(destination,files,boundary_geom=box(0,0,1,1),stats=stats)
+        self.assertContents(destination)
+        with zipfile.ZipFile(destination) as z:
+            self.assertIn('clipping_boundary.geojson',z.namelist())
+            self.assertEqual(z.getinfo('extract.osm.pbf').compress_type,zipfile.ZIP_STORED)
+            self.assertEqual(z.getinfo('text.gpkg').compress_type,zipfile.ZIP_DEFLATED)
+            self.assertLess(z.getinfo('text.gpkg').compress_size,len(self.contents['text.gpkg']) / 2)
+        self.assertEqual(stats['bytes_in'],sum(len(d) for d in self.contents.values()))
+        self.assertEqual(stats['bytes_out'],os.path.getsize(destination))
+
+    def test_small_chunks(self):
+        # members span many chunks, compressed on several threads
+        destination = self.path('out.zip')
+        with zipfile.ZipFile(destination,'w') as z:
+            write_members(z,[(name,self.path(name)) for name in sorted(self.contents)],workers=4,chunk_size=4096)
+        self.assertContents(destination)
+
+    def test_stored(self):
+        files = [File('gpkg',[self.path(name)]) for name in sorted(self.contents)]
+        destination = self.path('out.zip')
+        create_package(destination,files,compresslevel=0)
+        self.assertContents(destination)
+        with zipfile.ZipFile(destination) as z:
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in z.infolist()))
+
+    def test_stream(self):
+        destination = self.path('out.zip')
+        package = Package(destination)
+        stream = package.open('stream.geojsonl')
+        def produce():
+            for i in range(5000):
+                stream.write(b'{"type":"Feature","id":%d}\n' % i)
+            stream.close()
+        producer = threading.Thread(target=produce)
+        producer.start()
+        package.add([File('gpkg',[self.path(name)]) for name in sorted(self.contents)])
+        producer.join()
+        package.close()
+        self.assertContents(destination)
+        with zipfile.ZipFile(destination) as z:
+            self.assertEqual(z.read('stream.geojsonl'),b''.join(b'{"type":"Feature","id":%d}\n' % i for i in range(5000)))
+
+    def test_parallel_gzip(self):
+        data = b''.join(self.contents[name] for name in sorted(self.contents)) * 3
+        out = io.BytesIO()
+        gz = ParallelGzipWriter(out,workers=4,chunk_size=4096)
+        for i in range(0,len(data),1000):
+            gz.write(data[i:i+1000])
+        gz.close()
+        self.assertEqual(gzip.decompress(out.getvalue()),data)
+
+    def test_posm_bundle(self):
+        # the same part twice, and a copy of a part under another name
+        with open(self.path('copy.kml'),'wb') as f:
+            f.write(self.contents['small.kml'])
+        files = [
+            File('gpkg',[self.path('text.gpkg'),self.path('random.dbf')]),
+            File('kml',[self.path('small.kml'),self.path('copy.kml')]),
+            File('osm_pbf',[self.path('extract.osm.pbf'),self.path('extract.osm.pbf')])
+        ]
+        destination = self.path('bundle.tgz')
+        create_posm_bundle(destination,files,'Title','name','description',box(0,0,1,1),workers=4)
+        with tarfile.open(destination,'r:gz') as bundle:
+            manifest = json.load(bundle.extractfile('manifest.json'))
+            self.assertEqual(bundle.getmember('data/copy.kml').linkname,'data/small.kml')
+            self.assertTrue(bundle.getmember('data/text.gpkg').isfile())
+            self.assertEqual(len([m for m in bundle.getmembers() if m.name == 'osm/extract.osm.pbf']),1)
+            for target, entry in manifest['contents'].items():
+                data = self.contents[os.path.basename(target).replace('copy','small')]
+                self.assertEqual(bundle.extractfile(target).read(),data)
+                self.assertEqual(entry['size'],len(data))
+                self.assertEqual(entry['sha256'],hashlib.sha256(data).hexdigest())
+        self.assertEqual(manifest['contents']['data/copy.kml']['Type'],'KML')
+
+    def test_posm_bundle_error(self):
+        # the compression threads are stopped when a part can't be added
+        threads = threading.active_count()
+        files = [File('gpkg',[self.path('text.gpkg'),self.path('missing.gpkg')])]
+        with self.assertRaises(FileNotFoundError):
+            create_posm_bundle(self.path('bundle.tgz'),files,'Title','name','description',box(0,0,1,1),workers=4)
+        self.assertEqual(threading.active_count(),threads)
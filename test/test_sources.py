@@ -1,5 +1,12 @@
+import os
+import json
+import shutil
+import subprocess
+import tempfile
 import unittest
-from osm_export_tool.sources import Overpass
+from unittest import mock
+from shapely.geometry import LineString, MultiPolygon, box, mapping
+from osm_export_tool.sources import ExtractCache, Overpass, OsmiumTool
 from osm_export_tool.mapping import Mapping
 
 class TestMappingToOverpass(unittest.TestCase):
@@ -57,4 +64,183 @@ class TestSQLToOverpass(unittest.TestCase):
         s = Overpass.sql("name1 = 'foo' or name2 = 'bar'")
         self.assertEqual(s,["['name1'='foo']","['name2'='bar']"])
         s = Overpass.sql("(name1 = 'foo' and name2 = 'bar') or name3 = 'baz'")
-        self.assertEqual(s,["['name1'='foo']","['name2'='bar']","['name3'='baz']"])
\ No newline at end of file
+        self.assertEqual(s,["['name1'='foo']","['name2'='bar']","['name3'='baz']"])
+
+class TestExtractCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = ExtractCache(os.path.join(self.tempdir,'cache'),max_bytes=25)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self,name,data):
+        path = os.path.join(self.tempdir,name)
+        with open(path,'wb') as f:
+            f.write(data)
+        return path
+
+    def test_get_put(self):
+        out = os.path.join(self.tempdir,'out.osm.pbf')
+        self.assertFalse(self.cache.get('a',out))
+        self.cache.put('a',self.write('a.osm.pbf',b'a' * 10))
+        self.assertTrue(self.cache.get('a',out))
+        with open(out,'rb') as f:
+            self.assertEqual(f.read(),b'a' * 10)
+
+    def test_lru_eviction(self):
+        self.cache.put('a',self.write('a.osm.pbf',b'a' * 10))
+        self.cache.put('b',self.write('b.osm.pbf',b'b' * 10))
+        os.utime(self.cache.entry('a'),ns=(1,1))
+        os.utime(self.cache.entry('b'),ns=(2,2))
+        # a hit makes a the most recently used, so b is evicted
+        self.assertTrue(self.cache.get('a',os.path.join(self.tempdir,'out.osm.pbf')))
+        self.cache.put('c',self.write('c.osm.pbf',b'c' * 10))
+        self.assertTrue(os.path.isfile(self.cache.entry('a')))
+        self.assertFalse(os.path.isfile(self.cache.entry('b')))
+        self.assertTrue(os.path.isfile(self.cache.entry('c')))
+        # larger than the budget
+        self.cache.put('d',self.write('d.osm.pbf',b'd' * 30))
+        self.assertFalse(os.path.isfile(self.cache.entry('d')))
+
+    def test_parent(self):
+        self.cache.max_bytes = 100
+        source = ['planet.osm.pbf',1,1]
+        self.cache.put('country',self.write('country.osm.pbf',b'c' * 20),boundary=box(0,0,10,10),source=source)
+        self.cache.put('region',self.write('region.osm.pbf',b'r' * 10),boundary=box(0,0,2,2),source=source)
+        self.cache.put('other',self.write('other.osm.pbf',b'o' * 5),boundary=box(0,0,10,10),source=['other.osm.pbf',1,1])
+        self.assertEqual(self.cache.parent(source,box(1,1,2,2)),self.cache.entry('region'))
+        self.assertEqual(self.cache.parent(source,box(1,1,3,3)),self.cache.entry('country'))
+        self.assertIsNone(self.cache.parent(source,box(5,5,11,11)))
+        # evicting an entry unregisters it
+        for i, key in enumerate(['region','other','country']):
+            os.utime(self.cache.entry(key),ns=(i,i))
+        self.cache.max_bytes = 30
+        self.cache.evict(keep='country')
+        self.assertFalse(os.path.isfile(self.cache.boundary_path('region')))
+        self.assertEqual(self.cache.parent(source,box(1,1,2,2)),self.cache.entry('country'))
+
+    def test_osmium_key(self):
+        planet = self.write('planet.osm.pbf',b'planet')
+        mapping = Mapping("""
+        buildings:
+            select:
+                - building
+            where: building = 'yes'
+        """)
+        def key(geom=box(0,0,1,1),mapping=mapping):
+            return OsmiumTool('osmium',planet,geom,'out.osm.pbf',mapping=mapping).cache_key()
+        k = key()
+        self.assertEqual(k,key())
+        self.assertNotEqual(k,key(geom=box(0,0,1,2)))
+        self.assertNotEqual(k,key(mapping=None))
+        os.utime(planet,ns=(1,1))
+        self.assertNotEqual(k,key())
+
+class TestOsmiumToolCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = ExtractCache(os.path.join(self.tempdir,'cache'))
+        self.planet = os.path.join(self.tempdir,'planet.osm.pbf')
+        with open(self.planet,'wb') as f:
+            f.write(b'planet')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    # stands in for osmium: records the source and the polygons or extracts
+    # config of each extract, and fails when reading a source in fail.
+    def osmium(self,fail=()):
+        def check_call(cmd):
+            source = cmd[4]
+            if cmd[2] == '-c':
+                with open(cmd[3]) as f:
+                    extracts = json.load(f)['extracts']
+            else:
+                with open(cmd[3]) as f:
+                    extracts = [{'output':cmd[6],'geometry':json.load(f)['geometry']}]
+            self.calls.append((source,extracts))
+            if source in fail:
+                raise subprocess.CalledProcessError(1,cmd)
+            for e in extracts:
+                with open(e['output'],'wb') as f:
+                    f.write(b'extract')
+        return mock.patch('osm_export_tool.sources.subprocess.check_call',side_effect=check_call)
+
+    def register_parent(self,geom):
+        parent = OsmiumTool('osmium',self.planet,geom,os.path.join(self.tempdir,'parent.osm.pbf'),cache=self.cache)
+        with open(parent.output_path,'wb') as f:
+            f.write(b'parent')
+        parent.cache_extract()
+        return self.cache.entry(parent.cache_key(filtered=False))
+
+    def test_fetch_from_parent(self):
+        parent = self.register_parent(box(0,0,10,10))
+        tool = OsmiumTool('osmium',self.planet,box(1,1,2,2),os.path.join(self.tempdir,'out.osm.pbf'),tempdir=self.tempdir,cache=self.cache)
+        with self.osmium():
+            tool.fetch()
+        self.assertEqual([source for source, extracts in self.calls],[parent])
+        # not contained in the parent
+        tool.geom = box(5,5,11,11)
+        with self.osmium():
+            tool.fetch()
+        self.assertEqual(self.calls[-1][0],self.planet)
+
+    def test_fetch_parent_fails(self):
+        parent = self.register_parent(box(0,0,10,10))
+        tool = OsmiumTool('osmium',self.planet,box(1,1,2,2),os.path.join(self.tempdir,'out.osm.pbf'),tempdir=self.tempdir,cache=self.cache)
+        with self.osmium(fail=(parent,)):
+            tool.fetch()
+        self.assertEqual([source for source, extracts in self.calls],[parent,self.planet])
+        self.assertTrue(os.path.isfile(tool.output_path))
+        self.assertFalse(os.path.isfile(os.path.join(self.tempdir,'region.json')))
+
+    def test_extract_many_config(self):
+        multipolygon = MultiPolygon([box(20,20,21,21),box(22,22,23,23)])
+        extracts = [(box(0,0,1,1),os.path.join(self.tempdir,'a.osm.pbf')),(multipolygon,os.path.relpath(os.path.join(self.tempdir,'b.osm.pbf')))]
+        with self.osmium():
+            pbfs = OsmiumTool.extract_many('osmium',self.planet,extracts,self.tempdir)
+        self.assertEqual([pbf.path() for pbf in pbfs],[output_path for geom, output_path in extracts])
+        self.assertEqual(len(self.calls),1)
+        source, config = self.calls[0]
+        self.assertEqual(source,self.planet)
+        self.assertEqual(config,[
+            {'output':os.path.join(self.tempdir,'a.osm.pbf'),'polygon':json.loads(json.dumps(mapping(box(0,0,1,1))['coordinates']))},
+            {'output':os.path.join(self.tempdir,'b.osm.pbf'),'multipolygon':json.loads(json.dumps(mapping(multipolygon)['coordinates']))}
+        ])
+        self.assertFalse(os.path.isfile(os.path.join(self.tempdir,'extracts.json')))
+
+    def test_extract_many_cached(self):
+        def output(name):
+            return os.path.join(self.tempdir,name + '.osm.pbf')
+        with self.osmium():
+            OsmiumTool.extract_many('osmium',self.planet,[(box(0,0,10,10),output('a')),(box(20,20,21,21),output('b'))],self.tempdir,cache=self.cache)
+            os.remove(output('a'))
+            # a is cached; c and d are both within a, the smallest parent containing them
+            pbfs = OsmiumTool.extract_many('osmium',self.planet,[(box(0,0,10,10),output('a')),(box(1,1,2,2),output('c')),(box(3,3,4,4),output('d'))],self.tempdir,cache=self.cache)
+        self.assertTrue(all(os.path.isfile(pbf.path()) for pbf in pbfs))
+        source, config = self.calls[1]
+        parent = OsmiumTool('osmium',self.planet,box(0,0,10,10),output('a')).cache_key(filtered=False)
+        self.assertEqual(source,self.cache.entry(parent))
+        self.assertEqual([e['output'] for e in config],[output('c'),output('d')])
+
+    def test_extract_many_parent_fails(self):
+        parent = self.register_parent(box(0,0,10,10))
+        extracts = [(box(1,1,2,2),os.path.join(self.tempdir,'c.osm.pbf')),(box(3,3,4,4),os.path.join(self.tempdir,'d.osm.pbf'))]
+        with self.osmium(fail=(parent,)):
+            OsmiumTool.extract_many('osmium',self.planet,extracts,self.tempdir,cache=self.cache)
+        self.assertEqual([source for source, config in self.calls],[parent,self.planet])
+        self.assertFalse(os.path.isfile(os.path.join(self.tempdir,'extracts.json')))
+
+    def test_extract_many_fails(self):
+        with self.osmium(fail=(self.planet,)):
+            with self.assertRaises(subprocess.CalledProcessError):
+                OsmiumTool.extract_many('osmium',self.planet,[(box(0,0,1,1),os.path.join(self.tempdir,'a.osm.pbf'))],self.tempdir)
+        self.assertFalse(os.path.isfile(os.path.join(self.tempdir,'extracts.json')))
+
+    def test_extract_many_not_polygon(self):
+        with self.osmium():
+            with self.assertRaises(ValueError):
+                OsmiumTool.extract_many('osmium',self.planet,[(LineString([(0,0),(1,1)]),os.path.join(self.tempdir,'a.osm.pbf'))],self.tempdir)
+        self.assertEqual(self.calls,[])
@@ -1,5 +1,6 @@
+import pickle
 import unittest
-from osm_export_tool.sql import SQLValidator, Matcher
+from osm_export_tool.sql import SQLValidator, Matcher, _match
 
 class TestSql(unittest.TestCase):
 
@@ -144,3 +145,30 @@ class TestMatcher(unittest.TestCase):
         self.assertEqual(Matcher.from_sql(sql).to_sql(),sql)
         sql = "building > 0 OR building < 5"
         self.assertEqual(Matcher.from_sql(sql).to_sql(),sql)
+
+    def test_compiled_equivalent(self):
+        sqls = [
+            "building = 'yes' OR amenity IN ('bank','school')",
+            "(building IS NOT NULL AND height > 5) OR name != 'x'",
+            "level >= 2 AND level <= 4 AND level < 3",
+            "\"addr:housenumber\" = 1 OR \"addr:street\" IS NOT NULL",
+        ]
+        tag_sets = [{},{'building':'yes'},{'building':'no','height':'6'},{'amenity':'bank'},
+            {'name':'x'},{'name':'x','building':'a','height':'50'},{'level':'2'},{'level':'3'},
+            {'addr:housenumber':'1'},{'addr:street':'Main'},{'height':4}]
+        for sql in sqls:
+            m = Matcher.from_sql(sql)
+            for tags in tag_sets:
+                self.assertEqual(m.matches(tags),_match(m.expr,tags),(sql,tags))
+
+    def test_compiled_long_union(self):
+        m = Matcher.null()
+        for i in range(200):
+            m = m.union(Matcher.from_sql("key{0} = 'value'".format(i)))
+        self.assertTrue(m.matches({'key199':'value'}))
+        self.assertFalse(m.matches({'key200':'value'}))
+
+    def test_pickle(self):
+        m = pickle.loads(pickle.dumps(Matcher.from_sql("building IN ('one','two')")))
+        self.assertEqual(m.expr,('in','building',['one','two']))
+        self.assertTrue(m.matches({'building':'two'}))
@@ -0,0 +1,190 @@
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import osmium as o
+from shapely.geometry import Point, box
+from osm_export_tool import GeomType
+from osm_export_tool.mapping import Mapping
+
+# the tabular outputs need GDAL
+try:
+    import osm_export_tool.tabular as tabular
+except ImportError:
+    tabular = None
+
+MAPPINGS_DIR = os.path.join(os.path.dirname(__file__),'..','osm_export_tool','mappings')
+
+# the synthetic OSM files of the benchmarks
+spec = importlib.util.spec_from_file_location('fixtures',os.path.join(os.path.dirname(__file__),'..','benchmarks','fixtures.py'))
+fixtures = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fixtures)
+
+def load_mapping(name):
+    with open(os.path.join(MAPPINGS_DIR,name),'r') as f:
+        return Mapping(f.read())
+
+class Recorder:
+    """ An output that records what it is written. """
+
+    def __init__(self):
+        self.files = []
+        self.features = set()
+
+    def write(self,osm_id,layer_name,geom_type,geom,values):
+        self.features.add((osm_id,layer_name,geom_type,geom.wkb,tuple(values)))
+
+    def finalize(self):
+        pass
+
+    def of_type(self,geom_type):
+        return set(f for f in self.features if f[2] == geom_type)
+
+class FixtureTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp()
+        cls.osm_file = os.path.join(cls.tempdir,'fixture.osm.pbf')
+        fixtures.synthesize(cls.osm_file,nodes=20000,ways=3000,multipolygons=300)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def export(self,mapping,**kwargs):
+        recorder = Recorder()
+        tabular.Handler([recorder],mapping).apply_file(self.osm_file,idx='flex_mem',**kwargs)
+        return recorder
+
+@unittest.skipIf(tabular is None, 'GDAL is not installed')
+class TestLocationIndexType(unittest.TestCase):
+    def index_type(self,osm_file,size):
+        with mock.patch('osm_export_tool.tabular.os.path.getsize',return_value=size):
+            return tabular.location_index_type(osm_file)
+
+    def test_size(self):
+        self.assertEqual(self.index_type('small.osm.pbf',100 << 20),'flex_mem')
+        self.assertEqual(self.index_type('country.osm.pbf',4 << 30),'sparse_mmap_array')
+        self.assertEqual(self.index_type('planet.osm.pbf',70 << 30),'dense_mmap_array')
+
+    def test_xml(self):
+        # only uncompressed XML is much larger than PBF
+        self.assertEqual(self.index_type('country.osm',4 << 30),'flex_mem')
+        self.assertEqual(self.index_type('country.osm.bz2',4 << 30),'sparse_mmap_array')
+        self.assertEqual(self.index_type('country.osm.gz',4 << 30),'sparse_mmap_array')
+
+@unittest.skipIf(tabular is None, 'GDAL is not installed')
+class TestApplyFile(FixtureTestCase):
+    def test_area_candidates(self):
+        # the filtered area passes assemble the same areas as unfiltered ones
+        for name in ['default.yml','HDX_v2.yml']:
+            mapping = load_mapping(name)
+            filtered = self.export(mapping)
+            unfiltered = Recorder()
+            o.SimpleHandler.apply_file(tabular.Handler([unfiltered],mapping),self.osm_file,locations=True,idx='flex_mem')
+            self.assertTrue(any(f[0] < 0 for f in filtered.of_type(GeomType.POLYGON)))
+            self.assertEqual(filtered.features,unfiltered.features)
+
+    def test_without_locations(self):
+        mapping = load_mapping('HDX_v2.yml')
+        points = self.export(mapping,locations=False)
+        self.assertTrue(points.features)
+        self.assertEqual(points.features,self.export(mapping).of_type(GeomType.POINT))
+
+    def test_stats_tagged_nodes(self):
+        # every tagged node is either matched against the themes or skipped
+        tagged = []
+        def node(n):
+            if len(n.tags) > 0:
+                tagged.append(n.id)
+        o.make_simple_handler(node=node).apply_file(self.osm_file)
+        stats = tabular.Stats()
+        tabular.Handler([Recorder()],load_mapping('HDX_v2.yml'),stats=stats).apply_file(self.osm_file,locations=False)
+        self.assertTrue(stats.skipped_no_key)
+        self.assertEqual(stats.seen['point'] + stats.skipped_no_key,len(tagged))
+
+@unittest.skipIf(tabular is None, 'GDAL is not installed')
+class TestStats(unittest.TestCase):
+    def test_unparsed(self):
+        mapping = Mapping('''
+        buildings:
+          select:
+            - building:levels
+            - height: {type: real}
+        ''')
+        stats = tabular.Stats()
+        handler = tabular.Handler([Recorder()],mapping,stats=stats)
+        theme = mapping.themes[0]
+        for levels in ['2','2.5','2;3','two']:
+            handler.theme_values(theme,{'building:levels':levels,'height':'tall'})
+        self.assertEqual(stats.to_dict()['unparsed'],{'buildings':{'building:levels':2}})
+
+@unittest.skipIf(tabular is None, 'GDAL is not installed')
+class TestApplyFileParallel(FixtureTestCase):
+    def test_same_features(self):
+        for name in ['default.yml','HDX_v2.yml']:
+            mapping = load_mapping(name)
+            for clipping_geom in [None,box(-0.5,-0.5,0.5,0.7)]:
+                single = Recorder()
+                tabular.Handler([single],mapping,clipping_geom=clipping_geom).apply_file(self.osm_file,idx='flex_mem')
+                parallel = Recorder()
+                tempdir = tempfile.mkdtemp(dir=self.tempdir)
+                tabular.apply_file_parallel(self.osm_file,[parallel],mapping,3,tempdir,clipping_geom=clipping_geom)
+                self.assertTrue(single.features)
+                self.assertEqual(parallel.features,single.features)
+
+@unittest.skipIf(tabular is None, 'GDAL is not installed')
+class TestGeopackage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_finalize(self):
+        # rows are inserted with sqlite3, so check them through OGR
+        mapping = Mapping('''
+        Points of Interest:
+          types:
+            - points
+          select:
+            - name
+            - population
+            - ele
+          where: amenity IS NOT NULL
+        ''')
+        theme = mapping.themes[0]
+        tags = [
+            {'name':'a','population':'1200','ele':'35.5'},
+            {'name':"b's",'population':'many'},
+            {'ele':'-2'}
+        ]
+        points = [(1.0,2.0),(-3.0,4.5),(2.5,-1.0)]
+        gpkg = tabular.Geopackage(os.path.join(self.tempdir,'out'),mapping,batch_size=2)
+        for i, (t, (x, y)) in enumerate(zip(tags,points)):
+            gpkg.write(i + 1,theme.name,GeomType.POINT,tabular.Geometry(Point(x,y).wkb),theme.values(t))
+        gpkg.finalize()
+
+        ds = tabular.ogr.Open(os.path.join(self.tempdir,'out.gpkg'))
+        layer = ds.GetLayerByName('Points of Interest')
+        self.assertEqual(layer.GetFeatureCount(),3)
+        self.assertEqual(layer.GetExtent(),(-3.0,2.5,-1.0,4.5))
+        result = ds.ExecuteSQL("SELECT min_x, max_x, min_y, max_y FROM gpkg_contents WHERE table_name = 'Points of Interest'")
+        f = result.GetNextFeature()
+        self.assertEqual([f.GetField(i) for i in range(4)],[-3.0,2.5,-1.0,4.5])
+        ds.ReleaseResultSet(result)
+
+        defn = layer.GetLayerDefn()
+        types = {defn.GetFieldDefn(i).GetName():defn.GetFieldDefn(i).GetType() for i in range(defn.GetFieldCount())}
+        self.assertEqual(types,{'osm_id':tabular.ogr.OFTInteger64,'name':tabular.ogr.OFTString,'population':tabular.ogr.OFTInteger64,'ele':tabular.ogr.OFTReal})
+        rows = {}
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            rows[feature.GetField('osm_id')] = (feature.GetField('name'),feature.GetField('population'),feature.GetField('ele'),(geom.GetX(),geom.GetY()))
+        self.assertEqual(rows,{
+            1:('a',1200,35.5,(1.0,2.0)),
+            2:("b's",None,None,(-3.0,4.5)),
+            3:(None,None,-2.0,(2.5,-1.0))
+        })